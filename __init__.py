@@ -156,71 +156,84 @@
 
 # custom_components/special_agent/__init__.py
 
+import importlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final
 from homeassistant.core import HomeAssistant, ServiceCall
 from homeassistant.config_entries import ConfigEntry
-from .logger_helper import log_to_file
+from .config_helper import CONFIG_KEY, get_config_entry
+from .agent_logic import EXECUTOR_KEY, EXECUTOR_MAX_WORKERS, do_full_rebuild
+from .data_sources import async_setup_devices_cache
 
-DOMAIN = "special_agent"
+DOMAIN: Final = "special_agent"
+PLATFORMS: Final[tuple[str, ...]] = ("conversation",)
+SERVICE_REBUILD: Final = "rebuild_database"
 _LOGGER = logging.getLogger(__name__)
 
-async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
-    """Set up the Special Agent integration from a config entry."""
-    log_to_file(f"async_setup_entry called for {DOMAIN}")
-    hass.data.setdefault(DOMAIN, {})[entry.entry_id] = entry.data
+# The rebuild job currently in flight, if any; only one runs at a time.
+_rebuild_task = None
 
-    # 1) Register the custom service "special_agent.rebuild_database".
+async def async_setup(hass: HomeAssistant, config: dict) -> bool:
+    """Set up the Special Agent integration (runs once, before any config entry)."""
+
+    # Register the custom service "special_agent.rebuild_database" once; it lives
+    # for the lifetime of HA and is shared by all config entries.
     async def handle_rebuild_database(call: ServiceCall) -> None:
         """HA service that spawns the long rebuild job in the event loop."""
-        log_to_file("handle_rebuild_database called: will spawn background task.")
-        # This runs ON the event loop, so we can do:
-        hass.async_create_task(async_rebuild_database(hass))
-
-    hass.services.async_register(DOMAIN, "rebuild_database", handle_rebuild_database)
+        global _rebuild_task
+        if _rebuild_task is not None and not _rebuild_task.done():
+            _LOGGER.debug("rebuild_database: rebuild already running, skipping")
+            return
+
+        _LOGGER.debug("rebuild_database called: spawning background task")
+        entry = get_config_entry(hass)
+        if entry is None:
+            _LOGGER.warning("rebuild_database: no loaded config entry, skipping")
+            return
+        # Tie the job to the entry so HA cancels it if the entry is unloaded.
+        # eager_start runs the synchronous prologue now, up to the first await.
+        _rebuild_task = entry.async_create_background_task(
+            hass, do_full_rebuild(hass), "special_agent_rebuild", eager_start=True
+        )
+
+    hass.services.async_register(DOMAIN, SERVICE_REBUILD, handle_rebuild_database)
+    return True
 
-    # 2) Forward to conversation platform
-    await hass.config_entries.async_forward_entry_setups(entry, ["conversation"])
+async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
+    """Set up the Special Agent integration from a config entry."""
+    _LOGGER.debug("async_setup_entry called for %s", DOMAIN)
+    entry.runtime_data = entry.data
+    # Other modules read the config through config_helper.get_config_data(),
+    # which is a single hass.data lookup.
+    hass.data[CONFIG_KEY] = entry.runtime_data
+    async_setup_devices_cache(hass, entry)
+
+    # Blocking OpenAI calls run here rather than in HA's shared executor
+    hass.data[EXECUTOR_KEY] = ThreadPoolExecutor(
+        max_workers=EXECUTOR_MAX_WORKERS, thread_name_prefix="special_agent"
+    )
+
+    # Import the platform modules in the import executor so the forward below
+    # only hits sys.modules instead of importing on the event loop.
+    for platform in PLATFORMS:
+        await hass.async_add_import_executor_job(
+            importlib.import_module, f".{platform}", __package__
+        )
+
+    # Forward to our platforms (all imported/set up in one grouped call)
+    await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
     return True
 
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Unload the integration."""
-    log_to_file("async_unload_entry called.")
-    unload_ok = await hass.config_entries.async_unload_platforms(entry, ["conversation"])
-
-    # Optionally remove the service if you prefer
-    hass.services.async_remove(DOMAIN, "rebuild_database")
-
+    _LOGGER.debug("async_unload_entry called for %s", DOMAIN)
+    # HA cancels the entry's background tasks (a running rebuild) itself.
+    unload_ok = await hass.config_entries.async_unload_platforms(entry, PLATFORMS)
     if unload_ok:
-        hass.data[DOMAIN].pop(entry.entry_id)
+        hass.data.pop(CONFIG_KEY, None)
+        executor = hass.data.pop(EXECUTOR_KEY, None)
+        if executor is not None:
+            executor.shutdown(wait=False)
     return unload_ok
 
-
-#
-# This next function is the actual long-running job (the "async" function
-# that does your device fetch, entity states fetch, embedding, etc.)
-# We'll define it here or you can define it in agent_logic.py or data_sources.py,
-# but we have to import it in a cycle-safe way. 
-#
-
-async def async_rebuild_database(hass: HomeAssistant) -> None:
-    """
-    The actual long-running background job, spawned by handle_rebuild_database.
-    Must do any synchronous calls in the executor or purely async calls.
-    """
-    log_to_file("async_rebuild_database: START")
-
-    # Because this might import your agent_logic code, you need to be sure the
-    # imports do not cause cyclical references. If so, move it to another file
-    # and import it here. Or define everything directly here.
-
-    try:
-        from .agent_logic import do_full_rebuild  # A separate "sync or async" method
-        result = await do_full_rebuild(hass)  # if do_full_rebuild is async
-        log_to_file(f"async_rebuild_database result: {result}")
-    except Exception as e:
-        log_to_file(f"async_rebuild_database error: {e}")
-        _LOGGER.error("async_rebuild_database error: %s", e)
-
-    log_to_file("async_rebuild_database: END")
-
-    return
@@ -4,281 +4,391 @@
 # MAYBE CHECK HISTORY OF DEVICES IN HOME AND GENERATE PROFILE AUTOMATICALLY?
 # IF PLAYLIST ISN'T MATCH USE LLM TO TRY AGAIN
 
-import datetime
 import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import os
+import re
+import time
 import sys
 import subprocess
 
+import orjson
+
 from .data_sources import (
     get_ha_states, 
-    execute_ha_command, 
+    execute_ha_command_async, 
     get_devices_by_area
 )
-from .vector_index import build_vector_index, query_vector_index, load_vector_index
+from .vector_index import build_vector_index, query_vector_index, get_index, set_index, get_index_version, embed_query
 from .gpt_commands import (
-    classify_intent,
-    ask_gpt_for_refined_query,
-    ask_gpt_if_user_wants_music,
-    ask_gpt_for_spotify_query,
+    fast_classify,
+    classify_and_refine,
     ask_gpt_for_rest_command,
     generate_user_friendly_confirmation,
     generate_weather_response
 )
-from .spotify_integration import get_spotify_access_token, search_spotify
+from .spotify_integration import get_spotify_access_token_async, search_spotify_async
 from .logger_helper import log_to_file
 from .entity_refinement import filter_irrelevant_entities, rerank_and_filter_docs
 from .command_history import log_command
+from .config_helper import get_config_data
+from .rag_cache import get_rag_cache, get_semantic_cache, clear_semantic_cache
+from .weather import fetch_weather_data
+
+# Key in hass.data holding the integration's dedicated ThreadPoolExecutor.
+EXECUTOR_KEY = "special_agent_executor"
+EXECUTOR_MAX_WORKERS = 4
 
 # Session timeout in seconds (5 minutes)
 SESSION_TIMEOUT = 300
 
+# Max characters of a device doc included in the command prompt
+SNIPPET_LENGTH = 1000
+
+NO_DEVICES_MATCHED = "No devices matched. If the user wants to control a device, guess from context."
+
+# Accepted answers to a pending confirmation
+_YES = frozenset({"yes", "yep", "yeah", "sure", "go ahead"})
+_NO = frozenset({"no", "nope", "nah"})
+
 DOMAIN = "special_agent"
 
-def check_and_cleanup_sessions(pending_dict):
+_LOGGER = logging.getLogger(__name__)
+
+def add_session(pending_dict, expiry_heap, device_id, session):
     """
-    Check for timed-out sessions and clean them up to prevent memory leaks
+    Store a pending session for device_id, stamped with time.monotonic(),
+    and schedule its expiry on expiry_heap.
     """
-    now = datetime.datetime.now()
-    expired_sessions = []
-    
-    # Find all expired sessions
-    for device_id, session in pending_dict.items():
-        if "timestamp" in session:
-            session_time = session["timestamp"]
-            # Calculate session age in seconds
-            age = (now - session_time).total_seconds()
-            if age > SESSION_TIMEOUT:
-                expired_sessions.append(device_id)
-    
-    # Remove expired sessions
-    for device_id in expired_sessions:
-        log_to_file(f"[AgentLogic] Cleaning up expired session for device_id='{device_id}'")
-        pending_dict.pop(device_id, None)
-    
-    return len(expired_sessions)
+    session["timestamp"] = time.monotonic()
+    pending_dict[device_id] = session
+    heapq.heappush(expiry_heap, (session["timestamp"] + SESSION_TIMEOUT, device_id))
+
+def check_and_cleanup_sessions(pending_dict, expiry_heap):
+    """
+    Check for timed-out sessions and clean them up to prevent memory leaks.
+    Only pops heap entries that are due, so live sessions aren't scanned;
+    entries for sessions already answered or replaced are skipped.
+    """
+    now = time.monotonic()
+    cleaned = 0
+
+    while expiry_heap and expiry_heap[0][0] <= now:
+        _, device_id = heapq.heappop(expiry_heap)
+        session = pending_dict.get(device_id)
+        if session is not None and session["timestamp"] + SESSION_TIMEOUT <= now:
+            log_to_file(f"[AgentLogic] Cleaning up expired session for device_id='{device_id}'")
+            del pending_dict[device_id]
+            cleaned += 1
+
+    return cleaned
+
+async def _run_blocking(hass, func, *args, **kwargs):
+    """
+    Run a blocking helper (OpenAI HTTP calls, file I/O) in the integration's
+    own executor so the event loop stays free while it waits. Multi-second
+    LLM calls then don't hold threads in HA's shared pool. Falls back to
+    HA's executor when ours isn't set up (e.g. before async_setup_entry).
+    """
+    call = functools.partial(func, *args, **kwargs)
+    executor = hass.data.get(EXECUTOR_KEY)
+    if executor is None:
+        return await hass.async_add_executor_job(call)
+    return await hass.loop.run_in_executor(executor, call)
+
+def _find_related_docs(hass, refined_text, openai_api_key):
+    """
+    Return the re-ranked device docs for refined_text. Blocking (embedding
+    call + vector search), so run it through _run_blocking.
+    """
+    matrix, docs, dim = get_index(hass, openai_api_key)
+
+    # Repeated queries are answered without any embedding call. The key
+    # includes the index version, so a rebuild invalidates old entries.
+    rag_cache = get_rag_cache(hass)
+    cache_key = rag_cache.make_key(refined_text, get_index_version(hass))
+    final_docs = rag_cache.get(cache_key)
+    if final_docs is not None:
+        log_to_file(f"[AgentLogic] RAG cache hit for '{refined_text}'")
+        return final_docs
+
+    # Embed the refined query once; it's both the semantic cache key and
+    # the vector search query, so a cache miss costs no extra API call.
+    semcache = get_semantic_cache(hass)
+    query_vec = embed_query(refined_text, openai_api_key)
+    final_docs = semcache.lookup(query_vec) if query_vec is not None else None
+    if final_docs is not None:
+        log_to_file(f"[AgentLogic] Semantic cache hit for '{refined_text}'")
+        rag_cache.put(cache_key, final_docs)
+        return final_docs
+
+    top_docs = query_vector_index((matrix, docs, dim), refined_text, k=50, openai_api_key=openai_api_key, hass=hass, query_vector=query_vec)
+    final_docs = rerank_and_filter_docs(refined_text, top_docs, filter_qty=20)
+    # Only cache real search results, not the "index missing" placeholder
+    if matrix is not None:
+        rag_cache.put(cache_key, final_docs)
+        if query_vec is not None:
+            semcache.add(query_vec, final_docs)
+    return final_docs
+
+async def _fetch_spotify_token(hass, spotify_client_id, spotify_client_secret):
+    """Return a (usually cached) Spotify access token, or None on failure."""
+    try:
+        return await get_spotify_access_token_async(hass, spotify_client_id, spotify_client_secret)
+    except Exception as e:
+        log_to_file(f"[AgentLogic] Spotify token fetch failed => {e}")
+        return None
+
+async def _find_spotify_uri(hass, spotify_query, spotify_client_id, spotify_client_secret):
+    """
+    Fetch a Spotify access token (usually cached) and search for spotify_query.
+    Returns the best matching URI or None.
+    """
+    spotify_access_token = None
+    if spotify_client_id and spotify_client_secret:
+        spotify_access_token = await _fetch_spotify_token(hass, spotify_client_id, spotify_client_secret)
+    if not spotify_access_token:
+        log_to_file("[AgentLogic] No Spotify access token, skipping music search")
+        return None
+    try:
+        spotify_uri = await search_spotify_async(hass, spotify_access_token, spotify_query)
+    except Exception as e:
+        # Includes timeouts; the devices can still be controlled without music
+        log_to_file(f"[AgentLogic] Spotify search failed => {e}")
+        return None
+    log_to_file(f"[AgentLogic] search_spotify => {spotify_uri}")  # NEW LOG
+    return spotify_uri
+
+async def _handle_control(hass, user_text, device_id, classification, openai_api_key, spotify_credentials, pending_dict, expiry_heap):
+    """
+    'control' intent: find the related devices (and a Spotify URI if music
+    is wanted), ask GPT for the commands and store them as a pending session
+    awaiting confirmation. Returns (response, success).
+    """
+    refined_text = classification["refined_query"]
+    log_to_file("[AgentLogic] 'control' branch entered.")  # NEW LOG
+
+    # CHECK IF USER WANTS MUSIC + FIND RELATED DEVICES
+    # The Spotify token fetch and search overlap with the device search
+    spotify_uri = None
+    if classification["wants_music"]:
+        refined_text += ", media_player, sonos"
+        final_docs, spotify_uri = await asyncio.gather(
+            _run_blocking(hass, _find_related_docs, hass, refined_text, openai_api_key),
+            _find_spotify_uri(hass, classification["spotify_query"], *spotify_credentials),
+        )
+    else:
+        final_docs = await _run_blocking(hass, _find_related_docs, hass, refined_text, openai_api_key)
+
+    # BUILD COMBINED CONTEXT
+    # Docs longer than SNIPPET_LENGTH carry a pre-cut "snippet"
+    spotify_prefix = (f"The user wants music, please play on media player using spotify URI => {spotify_uri}",) if spotify_uri else ()
+    combined_context = "\n\n".join(itertools.chain(
+        spotify_prefix,
+        (doc.get("snippet", doc["page_content"]) for doc in final_docs) if final_docs else (NO_DEVICES_MATCHED,)
+    ))
+    log_to_file(f"[AgentLogic] combined_context (length={len(combined_context)}) => '{combined_context[:500]}'...")
+
+    # (e) ask_gpt_for_rest_command -> parse JSON -> execute
+    commands_json_str = await _run_blocking(hass, ask_gpt_for_rest_command, user_text, combined_context, api_key=openai_api_key)
+
+    # parse JSON
+    try:
+        commands_obj = orjson.loads(commands_json_str)
+        if isinstance(commands_obj, dict):
+            commands_list = [commands_obj]
+        elif isinstance(commands_obj, list):
+            commands_list = commands_obj
+        else:
+            # unknown format
+            return None, False
+        # if not isinstance(commands_list, list):
+        #     log_to_file("[AgentLogic] GPT returned non-list JSON.")
+        #     return None, False
+
+        log_to_file(f"[AgentLogic] commands_list => {commands_list}")  # NEW LOG
+
+        # Store pending commands in device-specific session
+        add_session(pending_dict, expiry_heap, device_id, {
+            "commands_list": commands_list,
+            "status": "awaiting_confirmation",
+            "entity_id": device_id
+        })
+
+        log_to_file(f"[AgentLogic] Created pending session for device_id='{device_id}' with {len(commands_list)} commands")
+
+        # Generate a user-friendly confirmation message using LLM
+        friendly_confirmation = await _run_blocking(
+            hass,
+            generate_user_friendly_confirmation,
+            user_text, 
+            commands_list, 
+            api_key=openai_api_key
+        )
+
+        # Log the command to history
+        await _run_blocking(
+            hass,
+            log_command,
+            user_text=user_text,
+            device_id=device_id,
+            session_id=device_id,
+            command_response=friendly_confirmation,
+            commands_list=commands_list,
+            success=None,  # Pending confirmation
+            metadata={"status": "awaiting_confirmation"}
+        )
+
+        # Return the user-friendly confirmation prompt
+        return friendly_confirmation, False
+
+
+        # success_flag = True
+        # for cmd in commands_list:
+        #     # You might want more logging here
+        #     log_to_file(f"[AgentLogic] About to execute cmd => {cmd}")  # NEW LOG
+        #     ok = execute_ha_command(cmd, hass=hass)
+        #     log_to_file(f"[AgentLogic] Command => {cmd}, success => {ok}")  # NEW LOG
+        #     if not ok:
+        #         success_flag = False
+
+        # log_to_file("[AgentLogic] DONE with control flow.")
+        # return commands_list, success_flag
+
+    except Exception as e:
+        log_to_file(f"[AgentLogic] JSON parse error => {e}")
+        return None, False
 
-def process_conversation_input(user_text, device_id, hass):
+async def _handle_weather(hass, user_text, device_id, openai_api_key):
+    """
+    'weather' intent: gather local sensor and online weather data and have
+    GPT phrase the answer. Returns (response, success).
+    """
+    log_to_file("[AgentLogic] Processing weather intent...")
+
+    try:
+        # Check if this is a query for weather in a specific location
+        location_query = None
+        location_patterns = [
+            r"(?:in|at|for|of)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+){0,2})",  # "weather in San Francisco"
+            r"([A-Z][a-z]+(?:\s+[A-Z][a-z]+){0,2})(?:'s|\s+weather)",    # "San Francisco's weather" or "San Francisco weather"
+        ]
+
+        for pattern in location_patterns:
+            match = re.search(pattern, user_text)
+            if match:
+                location_query = match.group(1)
+                log_to_file(f"[AgentLogic] Detected weather query for location: {location_query}")
+                break
+
+        # Run the weather collection function with potential location query
+        weather_data = await fetch_weather_data(hass, location_query=location_query)
+
+        log_to_file(f"[AgentLogic] Retrieved weather data: {len(weather_data.get('local_sensors', {}))} sensors")
+
+        # Generate weather response using LLM
+        weather_response = await _run_blocking(
+            hass,
+            generate_weather_response,
+            user_text,
+            weather_data.get('local_sensors', {}),
+            weather_data.get('online_weather', {}),
+            weather_data.get('location', {}),
+            api_key=openai_api_key
+        )
+
+        # Location for log history
+        location = ""
+        if location_query:
+            # If there's a location query, use that in the log
+            location = location_query
+        else:
+            # Otherwise use Home Assistant location
+            location = weather_data.get('location', {}).get("city", "") or \
+                      weather_data.get('location', {}).get("postal_code", "")
+
+        # Log the command to history
+        await _run_blocking(
+            hass,
+            log_command,
+            user_text=user_text,
+            device_id=device_id,
+            session_id=device_id,
+            command_response=weather_response,
+            success=True,
+            metadata={
+                "intent_type": "weather", 
+                "local_sensors": list(weather_data.get('local_sensors', {}).keys()),
+                "location": location,
+                "has_forecast": "weather_forecast" in weather_data.get('local_sensors', {}) and \
+                                len(weather_data.get('local_sensors', {}).get("weather_forecast", {}).get("forecast", [])) > 0
+            }
+        )
+
+        return weather_response, True
+
+    except Exception as e:
+        log_to_file(f"[AgentLogic] Error processing weather intent: {e}")
+        return f"I'm sorry, I had trouble retrieving the weather information. Please try again later.", False
+
+async def process_conversation_input(user_text, device_id, hass):
     """
     Updated flow with additional logging:
-      1) Classify intent
-      2) If 'control': 
-         (a) music check -> possible Spotify URI
-         (b) refine text -> short query
-         (c) build index -> get top docs -> re-rank
-         (d) build combined_context & log
-         (e) call ask_gpt_for_rest_command -> parse JSON -> execute
-      3) If 'weather' or 'question', placeholders
+      1) Pending session for this device -> handle_confirmation_phase
+      2) Classify intent, refine text and music check (one GPT call)
+      3) Dispatch: 'control' -> _handle_control, 'weather' -> _handle_weather,
+         'question' / 'rebuild_database' / 'test' handled inline
+
+    Runs on the event loop; every blocking helper goes through _run_blocking.
     """
 
     log_to_file(f"[AgentLogic] START process_conversation_input: device_id='{device_id}', user_text='{user_text}'")
 
     # Retrieve config
-    config_entries = hass.data.get("special_agent", {})
-    config_data = next(iter(config_entries.values())) if config_entries else {}
+    config_data = get_config_data(hass)
     openai_api_key = config_data.get("openai_api_key", "")
     spotify_client_id = config_data.get("spotify_client_id", "")
     spotify_client_secret = config_data.get("spotify_client_secret", "")
 
     # Get or create sessions dictionary and clean up expired sessions
     pending_dict = hass.data.setdefault("special_agent_pending", {})
-    cleaned_count = check_and_cleanup_sessions(pending_dict)
+    expiry_heap = hass.data.setdefault("special_agent_pending_expiry", [])
+    cleaned_count = check_and_cleanup_sessions(pending_dict, expiry_heap)
     if cleaned_count > 0:
         log_to_file(f"[AgentLogic] Cleaned up {cleaned_count} expired sessions")
     
     # Check for existing session for this device
     pending = pending_dict.get(device_id)
     if pending and pending.get("status") == "awaiting_confirmation":
-        return handle_confirmation_phase(user_text, hass, pending, device_id)
-
-    # 1) Classify intent
-    intent_type = classify_intent(user_text, api_key=openai_api_key)
+        return await handle_confirmation_phase(user_text, hass, pending, device_id, pending_dict)
+
+    # 1) Classify intent. The refined query, music check and Spotify query
+    #    only depend on user_text, so they come back from the same call.
+    fast_intent = fast_classify(user_text)
+    if fast_intent is not None:
+        # Obvious weather questions don't need the GPT round-trip
+        classification = {"intent": fast_intent, "refined_query": user_text, "wants_music": False, "spotify_query": user_text}
+    else:
+        classification = await _run_blocking(hass, classify_and_refine, user_text, api_key=openai_api_key)
+    intent_type = classification["intent"]
     log_to_file(f"[AgentLogic] Intent => {intent_type}")  # NEW LOG
 
     if intent_type == "control":
-        log_to_file("[AgentLogic] 'control' branch entered.")  # NEW LOG
-
-        # REFINE RAG QUERY
-        refined_text = ask_gpt_for_refined_query(user_text, api_key=openai_api_key)
-
-        # CHECK IF USER WANTS MUSIC
-        music_check = ask_gpt_if_user_wants_music(user_text, api_key=openai_api_key)
-        spotify_uri = None
-        if music_check == "true":
-            refined_text += ", media_player, sonos"
-            spotify_query = ask_gpt_for_spotify_query(user_text, api_key=openai_api_key)
-            spotify_access_token = get_spotify_access_token(spotify_client_id, spotify_client_secret)
-            spotify_uri = search_spotify(spotify_access_token, spotify_query)
-            log_to_file(f"[AgentLogic] search_spotify => {spotify_uri}")  # NEW LOG
-
-        # FIND RELATED DEVICES
-        matrix, docs, dim = load_vector_index(openai_api_key)
-        top_docs = query_vector_index((matrix, docs, dim), refined_text, k=50, openai_api_key=openai_api_key, hass=hass)
-        final_docs = rerank_and_filter_docs(refined_text, top_docs, filter_qty=20)
-
-        # BUILD COMBINED CONTEXT
-        aggregated_context = []
-        if spotify_uri:
-            aggregated_context.append(f"The user wants music, please play on media player using spotify URI => {spotify_uri}")
-        if len(final_docs) == 0:
-            aggregated_context.append(
-                "No devices matched. If the user wants to control a device, guess from context."
-            )
-        else:
-            for doc in final_docs:
-                snippet = doc["page_content"][:1000]  # access via dict key
-                aggregated_context.append(snippet)
-        combined_context = "\n\n".join(aggregated_context)
-        log_to_file(f"[AgentLogic] combined_context (length={len(combined_context)}) => '{combined_context[:500]}'...")
-
-        # (e) ask_gpt_for_rest_command -> parse JSON -> execute
-        commands_json_str = ask_gpt_for_rest_command(user_text, combined_context, api_key=openai_api_key)
-
-        # parse JSON
-        import json
-        try:
-            commands_obj = json.loads(commands_json_str)
-            if isinstance(commands_obj, dict):
-                commands_list = [commands_obj]
-            elif isinstance(commands_obj, list):
-                commands_list = commands_obj
-            else:
-                # unknown format
-                return None, False
-            # if not isinstance(commands_list, list):
-            #     log_to_file("[AgentLogic] GPT returned non-list JSON.")
-            #     return None, False
-
-            log_to_file(f"[AgentLogic] commands_list => {commands_list}")  # NEW LOG
-
-            # Store pending commands in device-specific session
-            timestamp = datetime.datetime.now()
-            pending_dict[device_id] = {
-                "commands_list": commands_list,
-                "status": "awaiting_confirmation",
-                "timestamp": timestamp,
-                "entity_id": device_id
-            }
-            
-            log_to_file(f"[AgentLogic] Created pending session for device_id='{device_id}' with {len(commands_list)} commands")
-            
-            # Generate a user-friendly confirmation message using LLM
-            friendly_confirmation = generate_user_friendly_confirmation(
-                user_text, 
-                commands_list, 
-                api_key=openai_api_key
-            )
-            
-            # Log the command to history
-            log_command(
-                user_text=user_text,
-                device_id=device_id,
-                session_id=device_id,
-                command_response=friendly_confirmation,
-                commands_list=commands_list,
-                success=None,  # Pending confirmation
-                metadata={"status": "awaiting_confirmation"}
-            )
-            
-            # Return the user-friendly confirmation prompt
-            return friendly_confirmation, False
-
-
-            # success_flag = True
-            # for cmd in commands_list:
-            #     # You might want more logging here
-            #     log_to_file(f"[AgentLogic] About to execute cmd => {cmd}")  # NEW LOG
-            #     ok = execute_ha_command(cmd, hass=hass)
-            #     log_to_file(f"[AgentLogic] Command => {cmd}, success => {ok}")  # NEW LOG
-            #     if not ok:
-            #         success_flag = False
-
-            # log_to_file("[AgentLogic] DONE with control flow.")
-            # return commands_list, success_flag
-
-        except Exception as e:
-            log_to_file(f"[AgentLogic] JSON parse error => {e}")
-            return None, False
-
+        return await _handle_control(
+            hass, user_text, device_id, classification, openai_api_key,
+            (spotify_client_id, spotify_client_secret), pending_dict, expiry_heap
+        )
     elif intent_type == "weather":
-        log_to_file("[AgentLogic] Processing weather intent...")
-        
-        from .weather import fetch_weather_data
-        
-        try:
-            # Check if this is a query for weather in a specific location
-            import re
-            location_query = None
-            location_patterns = [
-                r"(?:in|at|for|of)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+){0,2})",  # "weather in San Francisco"
-                r"([A-Z][a-z]+(?:\s+[A-Z][a-z]+){0,2})(?:'s|\s+weather)",    # "San Francisco's weather" or "San Francisco weather"
-            ]
-            
-            for pattern in location_patterns:
-                match = re.search(pattern, user_text)
-                if match:
-                    location_query = match.group(1)
-                    log_to_file(f"[AgentLogic] Detected weather query for location: {location_query}")
-                    break
-            
-            # Handle the case where there's no event loop in the current thread
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                # Create a new event loop if one doesn't exist in this thread
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-            
-            # Run the weather collection function with potential location query
-            weather_data = loop.run_until_complete(fetch_weather_data(hass, location_query=location_query))
-            
-            log_to_file(f"[AgentLogic] Retrieved weather data: {len(weather_data.get('local_sensors', {}))} sensors")
-            
-            # Generate weather response using LLM
-            weather_response = generate_weather_response(
-                user_text,
-                weather_data.get('local_sensors', {}),
-                weather_data.get('online_weather', {}),
-                weather_data.get('location', {}),
-                api_key=openai_api_key
-            )
-            
-            # Location for log history
-            location = ""
-            if location_query:
-                # If there's a location query, use that in the log
-                location = location_query
-            else:
-                # Otherwise use Home Assistant location
-                location = weather_data.get('location', {}).get("city", "") or \
-                          weather_data.get('location', {}).get("postal_code", "")
-            
-            # Log the command to history
-            log_command(
-                user_text=user_text,
-                device_id=device_id,
-                session_id=device_id,
-                command_response=weather_response,
-                success=True,
-                metadata={
-                    "intent_type": "weather", 
-                    "local_sensors": list(weather_data.get('local_sensors', {}).keys()),
-                    "location": location,
-                    "has_forecast": "weather_forecast" in weather_data.get('local_sensors', {}) and \
-                                    len(weather_data.get('local_sensors', {}).get("weather_forecast", {}).get("forecast", [])) > 0
-                }
-            )
-            
-            return weather_response, True
-            
-        except Exception as e:
-            log_to_file(f"[AgentLogic] Error processing weather intent: {e}")
-            return f"I'm sorry, I had trouble retrieving the weather information. Please try again later.", False
+        return await _handle_weather(hass, user_text, device_id, openai_api_key)
     elif intent_type == "question":
         log_to_file("[AgentLogic] Q&A not implemented yet.")
         return "Question not implemented", True
     elif intent_type == "rebuild_database":
         log_to_file("[AgentLogic] Rebuild requested => calling HA service in background.")
-        hass.services.call(DOMAIN, "rebuild_database", {})
+        await hass.services.async_call(DOMAIN, "rebuild_database", {})
         return "Rebuilding database in the background...", True
 
         # log_to_file("[AgentLogic] Rebuilding database start")
@@ -296,6 +406,21 @@ def process_conversation_input(user_text, device_id, hass):
         log_to_file("[AgentLogic] Unknown intent => no action.")
         return None, False
 
+def build_docs(refined_states):
+    """
+    Turn refined entity states into index docs. Content longer than
+    SNIPPET_LENGTH also gets a pre-cut "snippet" so the prompt context is
+    built without slicing strings on every request.
+    """
+    docs = []
+    for s in refined_states:
+        content = f"Entity: {s['entity_id']}\nName: {s['name']}\nAttributes: {s['attributes']}\n"
+        doc = {"page_content": content, "metadata": {"entity_id": s["entity_id"]}}
+        if len(content) > SNIPPET_LENGTH:
+            doc["snippet"] = content[:SNIPPET_LENGTH]
+        docs.append(doc)
+    return docs
+
 def sync_do_rebuild(hass):
     """
     Synchronous version of the rebuild function that can be called within the same thread.
@@ -304,55 +429,63 @@ def sync_do_rebuild(hass):
     log_to_file("[AgentLogic] sync_do_rebuild: START")
     
     try:
-        config_entries = hass.data.get("special_agent", {})
-        config_data = next(iter(config_entries.values())) if config_entries else {}
+        config_data = get_config_data(hass)
         openai_api_key = config_data.get("openai_api_key", "")
         
-        from .data_sources import get_ha_states
-        from .entity_refinement import filter_irrelevant_entities
-        from .vector_index import build_vector_index
-        
         # 1) Get all states synchronously
         all_states = get_ha_states(hass)
         refined_states = filter_irrelevant_entities(all_states)
         log_to_file(f"[AgentLogic] sync_do_rebuild: got {len(refined_states)} refined states")
         
         # 2) Build docs
-        docs = []
-        for s in refined_states:
-            content = f"Entity: {s['entity_id']}\nName: {s['name']}\nAttributes: {s['attributes']}\n"
-            docs.append({"page_content": content, "metadata": {"entity_id": s["entity_id"]}})
+        docs = build_docs(refined_states)
         
         # 3) Build vector index
-        result = build_vector_index(
+        embedding_matrix, final_docs, dim = build_vector_index(
             docs,
             openai_api_key=openai_api_key,
             force_rebuild=True
         )
+        if embedding_matrix is not None:
+            set_index(hass, embedding_matrix, final_docs, dim)
+        clear_semantic_cache(hass)
         log_to_file("[AgentLogic] sync_do_rebuild: success")
         return "done"
     except Exception as e:
         log_to_file(f"[AgentLogic] sync_do_rebuild: error => {e}")
         return f"error: {e}"
 
+def _write_device_summary(summary, devices):
+    """
+    Write data/device_area_summary.json. Blocking (encoding + file I/O), so
+    do_full_rebuild runs it in the executor.
+    """
+    data_folder = os.path.join(os.path.dirname(__file__), "data")
+    os.makedirs(data_folder, exist_ok=True)
+    summary_file = os.path.join(data_folder, "device_area_summary.json")
+    # Compact by default; pretty-printed only when debug logging is on
+    option = orjson.OPT_NON_STR_KEYS
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        option |= orjson.OPT_INDENT_2
+    # Write to a temp file and swap it in so readers never see a partial summary
+    tmp_file = summary_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(orjson.dumps({"summary": summary, "devices": devices}, option=option))
+    os.replace(tmp_file, summary_file)
+
 async def do_full_rebuild(hass):
     """
     Async method that does the heavy lifting: get devices, states, filter, embed, etc.
-    This is called from async_rebuild_database in __init__.py
-    or we can import and call it from the service directly.
+    Spawned as a background task by the rebuild_database service in __init__.py.
+    Returns "done" or an "error: ..." string, like sync_do_rebuild.
     """
     log_to_file("[AgentLogic] do_full_rebuild: START")
 
-    config_entries = hass.data.get("special_agent", {})
-    config_data = next(iter(config_entries.values())) if config_entries else {}
+    config_data = get_config_data(hass)
     openai_api_key = config_data.get("openai_api_key", "")
 
     try:
         # 1) get devices from data_sources
-        from .data_sources import get_devices_by_area, get_ha_states
-        from .entity_refinement import filter_irrelevant_entities
-        from .vector_index import build_vector_index
-
         summary, devices = await get_devices_by_area(hass)
         log_to_file(f"[AgentLogic] got {len(devices)} devices")
 
@@ -363,10 +496,7 @@ async def do_full_rebuild(hass):
         log_to_file(f"[AgentLogic] refined => {len(refined_states)} states")
 
         # 2) Build doc dict
-        docs = []
-        for s in refined_states:
-            content = f"Entity: {s['entity_id']}\nName: {s['name']}\nAttributes: {s['attributes']}\n"
-            docs.append({"page_content": content, "metadata": {"entity_id": s["entity_id"]}})
+        docs = build_docs(refined_states)
 
         # 3) Because "build_vector_index" might do blocking I/O (OpenAI calls),
         #    we run it in the executor:
@@ -379,47 +509,63 @@ async def do_full_rebuild(hass):
             )
 
         embedding_matrix, final_docs, dim = await hass.async_add_executor_job(sync_build_index)
+        if embedding_matrix is not None:
+            set_index(hass, embedding_matrix, final_docs, dim)
+        clear_semantic_cache(hass)
         log_to_file(f"[AgentLogic] index built with shape {embedding_matrix.shape if embedding_matrix is not None else None}")
 
         # 4) Save summary, etc.
-        import os, json
-        base_dir = os.path.dirname(__file__)
-        data_folder = os.path.join(base_dir, "data")
-        os.makedirs(data_folder, exist_ok=True)
-        summary_file = os.path.join(data_folder, "device_area_summary.json")
-        with open(summary_file, "w", encoding="utf-8") as f:
-            json.dump({"summary": summary, "devices": devices}, f, indent=2)
+        await hass.async_add_executor_job(_write_device_summary, summary, devices)
 
         log_to_file("[AgentLogic] do_full_rebuild: success")
         return "done"
     except Exception as e:
         log_to_file(f"[AgentLogic] do_full_rebuild: error => {e}")
-        raise
+        _LOGGER.error("do_full_rebuild error: %s", e)
+        return f"error: {e}"
 
-def handle_confirmation_phase(user_text, hass, pending, device_id):
+async def _execute_commands(hass, commands_list):
+    """
+    Run the confirmed commands concurrently and return a success flag per
+    command. Commands targeting the same entity_id still run in order (e.g.
+    set the volume, then play media on the same speaker).
+    """
+    results = [False] * len(commands_list)
+    groups = {}
+    for i, cmd in enumerate(commands_list):
+        entity_id = cmd.get("data", {}).get("entity_id") if isinstance(cmd, dict) else None
+        groups.setdefault(str(entity_id), []).append(i)
+
+    async def run_group(indexes):
+        for i in indexes:
+            results[i] = await execute_ha_command_async(commands_list[i], hass=hass)
+
+    await asyncio.gather(*(run_group(indexes) for indexes in groups.values()))
+    return results
+
+async def handle_confirmation_phase(user_text, hass, pending, device_id, pending_dict):
     """
     If user says "yes", we execute pending commands for this device.
-    If "no", we discard them.
+    If "no", we discard them. pending_dict is the caller's session dict
+    holding `pending` under device_id.
     """
     lowered = user_text.strip().lower()
-    pending_dict = hass.data.setdefault("special_agent_pending", {})
     
     log_to_file(f"[AgentLogic] handle_confirmation_phase for device_id='{device_id}', user_text='{user_text}'")
     commands_list = pending.get("commands_list", [])
 
-    if lowered in ["yes", "yep", "yeah", "sure", "go ahead"]:
+    if lowered in _YES:
         # Track successful and failed commands
         success_flag = True
         failed_cmds = []
         
-        # Execute each command and record failures
-        for cmd in commands_list:
-            service_name = cmd.get("service", "unknown")
-            entity_id = cmd.get("data", {}).get("entity_id", "unknown")
-            ok = execute_ha_command(cmd, hass=hass)
-            
+        # Execute the commands and record failures
+        results = await _execute_commands(hass, commands_list)
+        for cmd, ok in zip(commands_list, results):
             if not ok:
                 success_flag = False
+                service_name = cmd.get("service", "unknown")
+                entity_id = cmd.get("data", {}).get("entity_id", "unknown")
                 failed_cmds.append(f"{service_name} for {entity_id}")
 
         # Clear the pending state for this device
@@ -439,7 +585,9 @@ def handle_confirmation_phase(user_text, hass, pending, device_id):
                     response += f" and {len(failed_cmds) - 2} more"
         
         # Log to command history
-        log_command(
+        await _run_blocking(
+            hass,
+            log_command,
             user_text=user_text,
             device_id=device_id,
             session_id=device_id,
@@ -451,13 +599,15 @@ def handle_confirmation_phase(user_text, hass, pending, device_id):
         
         return (response, success_flag)
 
-    elif lowered in ["no", "nope", "nah"]:
+    elif lowered in _NO:
         # Discard the pending request
         log_to_file(f"[AgentLogic] Canceling request and clearing session for device_id='{device_id}'")
         pending_dict.pop(device_id, None)
         
         # Log to command history
-        log_command(
+        await _run_blocking(
+            hass,
+            log_command,
             user_text=user_text,
             device_id=device_id,
             session_id=device_id,
@@ -1,11 +1,29 @@
+import atexit
 import os
-import json
 import datetime
+import threading
+from collections import deque
+
+import orjson
+
 from .logger_helper import log_to_file
 
 # Get the directory where this file is located
 COMPONENT_DIR = os.path.dirname(os.path.abspath(__file__))
-HISTORY_FILE = os.path.join(COMPONENT_DIR, "command_history.json")
+# One JSON object per line (NDJSON), appended per command
+HISTORY_FILE = os.path.join(COMPONENT_DIR, "command_history.ndjson")
+
+# Keep the most recent MAX_HISTORY_ENTRIES. The file is only trimmed once it
+# has grown ROTATE_SLACK entries past that, so rotation is rare.
+MAX_HISTORY_ENTRIES = 1000
+ROTATE_SLACK = 200
+
+# Lines currently in HISTORY_FILE (counted on first write)
+_history_count = None
+# Raw O_APPEND descriptor; each entry is a single os.write, so lines from
+# concurrent writers never interleave and nothing sits in a user-space buffer.
+_history_fd = None
+_history_lock = threading.Lock()
 
 # Check if we're running in a test environment
 IN_TESTING = os.environ.get('SPECIAL_AGENT_TESTING') == 'true'
@@ -20,7 +38,7 @@ def log_command(
     metadata: dict = None
 ):
     """
-    Log command history to a structured JSON file.
+    Append a command to the JSON Lines history file.
     
     Args:
         user_text: The original user request
@@ -51,46 +69,77 @@ def log_command(
             
         # Add commands list if provided (simplified version)
         if commands_list:
-            simplified_commands = []
-            for cmd in commands_list:
-                if isinstance(cmd, dict):
-                    service = cmd.get("service", "unknown")
-                    entity_id = cmd.get("data", {}).get("entity_id", "unknown")
-                    simplified_cmd = {
-                        "service": service,
-                        "entity_id": entity_id
-                    }
-                    simplified_commands.append(simplified_cmd)
-            entry["commands"] = simplified_commands
+            try:
+                simplified_commands = [_simplify_command(cmd) for cmd in commands_list]
+            except AttributeError:
+                # Rare: something other than a dict slipped into the list, skip it
+                simplified_commands = [_simplify_command(cmd) for cmd in commands_list if isinstance(cmd, dict)]
+            if simplified_commands:
+                entry["commands"] = simplified_commands
         
         # If we're in a test environment, don't try to read/write files
         if IN_TESTING:
             log_to_file(f"[CommandHistory] Test mode - would log command: {user_text}")
             return
             
-        # Load existing history if it exists
-        history = []
-        if os.path.exists(HISTORY_FILE):
-            try:
-                with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                    history = json.load(f)
-            except Exception as e:
-                log_to_file(f"[CommandHistory] Error loading history file: {e}")
-                # Start with empty history if file is corrupted
-                history = []
-        
-        # Add new entry
-        history.append(entry)
-        
-        # Limit history size (keep last 1000 entries)
-        if len(history) > 1000:
-            history = history[-1000:]
-        
-        # Save history
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(history, f, indent=2)
+        _append_entry(entry)
             
         log_to_file(f"[CommandHistory] Logged command: {user_text}")
         
     except Exception as e:
-        log_to_file(f"[CommandHistory] Error logging command: {e}")
\ No newline at end of file
+        log_to_file(f"[CommandHistory] Error logging command: {e}")
+
+def _simplify_command(cmd):
+    return {
+        "service": cmd.get("service", "unknown"),
+        "entity_id": cmd.get("data", {}).get("entity_id", "unknown")
+    }
+
+def _append_entry(entry):
+    """Append one entry to HISTORY_FILE, trimming the file when it's too long."""
+    global _history_count, _history_fd
+    line = orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+    with _history_lock:
+        if _history_count is None:
+            _history_count = _count_lines()
+        if _history_fd is None:
+            _history_fd = os.open(HISTORY_FILE, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+        os.write(_history_fd, line)
+        _history_count += 1
+
+        if _history_count > MAX_HISTORY_ENTRIES + ROTATE_SLACK:
+            # The rotated file replaces the one our descriptor points at
+            _close_fd()
+            _rotate()
+
+def close_history():
+    """Close the history file descriptor (registered with atexit)."""
+    with _history_lock:
+        _close_fd()
+
+def _close_fd():
+    global _history_fd
+    if _history_fd is not None:
+        os.close(_history_fd)
+        _history_fd = None
+
+atexit.register(close_history)
+
+def _count_lines():
+    if not os.path.exists(HISTORY_FILE):
+        return 0
+    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
+        return sum(1 for _ in f)
+
+def _rotate():
+    """Rewrite HISTORY_FILE with only its last MAX_HISTORY_ENTRIES lines."""
+    global _history_count
+    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
+        tail = deque(f, maxlen=MAX_HISTORY_ENTRIES)
+    tmp_file = HISTORY_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.writelines(tail)
+    os.replace(tmp_file, HISTORY_FILE)
+    _history_count = len(tail)
+    log_to_file(f"[CommandHistory] Rotated history file to {_history_count} entries")
\ No newline at end of file
@@ -1,9 +1,42 @@
+from functools import lru_cache
+
 import voluptuous as vol
 from homeassistant import config_entries
 from .logger_helper import log_to_file
 
 DOMAIN = "special_agent"
 
+_USER_SCHEMA = vol.Schema({
+    vol.Optional("openai_api_key", default=""): str,
+    vol.Optional("spotify_client_id", default=""): str,
+    vol.Optional("spotify_client_secret", default=""): str,
+    vol.Optional("zip_code", default=""): str,
+    vol.Optional("weather_station_id", default="washington_weather_station"): str,
+})
+
+# Option keys, in _build_options_schema's argument order, with the default
+# used when neither the options nor the original entry data have a value.
+_OPTION_DEFAULTS = (
+    ("openai_api_key", ""),
+    ("spotify_client_id", ""),
+    ("spotify_client_secret", ""),
+    ("zip_code", ""),
+    ("weather_station_id", "washington_weather_station"),
+)
+
+_EMPTY = {}
+
+@lru_cache(maxsize=32)
+def _build_options_schema(openai_api_key, spotify_client_id, spotify_client_secret, zip_code, weather_station_id):
+    """Options form schema for the given current values, built once per distinct set."""
+    return vol.Schema({
+        vol.Optional("openai_api_key", default=openai_api_key): str,
+        vol.Optional("spotify_client_id", default=spotify_client_id): str,
+        vol.Optional("spotify_client_secret", default=spotify_client_secret): str,
+        vol.Optional("zip_code", default=zip_code): str,
+        vol.Optional("weather_station_id", default=weather_station_id): str,
+    })
+
 class SpecialAgentConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     """Handle a config flow for Special Agent."""
     VERSION = 1
@@ -18,13 +51,7 @@ class SpecialAgentConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         log_to_file("[ConfigFlow] Showing user form.")
         return self.async_show_form(
             step_id="user",
-            data_schema=vol.Schema({
-                vol.Optional("openai_api_key", default=""): str,
-                vol.Optional("spotify_client_id", default=""): str,
-                vol.Optional("spotify_client_secret", default=""): str,
-                vol.Optional("zip_code", default=""): str,
-                vol.Optional("weather_station_id", default="washington_weather_station"): str,
-            }),
+            data_schema=_USER_SCHEMA,
             errors={}
         )
 
@@ -42,27 +69,9 @@ class SpecialAgentOptionsFlow(config_entries.OptionsFlow):
         if user_input is not None:
             return self.async_create_entry(title="", data=user_input)
 
-        current = dict(self.config_entry.options or {})
-        schema = vol.Schema({
-            vol.Optional(
-                "openai_api_key",
-                default=current.get("openai_api_key", self.config_entry.data.get("openai_api_key", ""))
-            ): str,
-            vol.Optional(
-                "spotify_client_id",
-                default=current.get("spotify_client_id", self.config_entry.data.get("spotify_client_id", ""))
-            ): str,
-            vol.Optional(
-                "spotify_client_secret",
-                default=current.get("spotify_client_secret", self.config_entry.data.get("spotify_client_secret", ""))
-            ): str,
-            vol.Optional(
-                "zip_code",
-                default=current.get("zip_code", self.config_entry.data.get("zip_code", ""))
-            ): str,
-            vol.Optional(
-                "weather_station_id",
-                default=current.get("weather_station_id", self.config_entry.data.get("weather_station_id", "washington_weather_station"))
-            ): str,
-        })
+        options = self.config_entry.options or _EMPTY
+        data = self.config_entry.data
+        schema = _build_options_schema(
+            *(options[key] if key in options else data.get(key, default) for key, default in _OPTION_DEFAULTS)
+        )
         return self.async_show_form(step_id="init", data_schema=schema)
@@ -0,0 +1,25 @@
+from homeassistant.config_entries import ConfigEntryState
+
+DOMAIN = "special_agent"
+
+# Key in hass.data holding the loaded entry's config data, set by
+# async_setup_entry so lookups on the hot path are a single dict access.
+CONFIG_KEY = "special_agent_config"
+
+def get_config_entry(hass):
+    """
+    Return the loaded Special Agent config entry, or None if there isn't one.
+    The config flow only allows a single entry, so the first loaded one wins.
+    runtime_data outlives an unload, so the entry state is checked instead.
+    """
+    for entry in hass.config_entries.async_entries(DOMAIN):
+        if entry.state is ConfigEntryState.LOADED:
+            return entry
+    return None
+
+def get_config_data(hass):
+    """
+    Return the config data (API keys, zip code, ...) cached in hass.data by
+    async_setup_entry, or an empty dict if nothing is loaded.
+    """
+    return hass.data.get(CONFIG_KEY, {})
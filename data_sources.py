@@ -6,6 +6,7 @@ import json
 import logging
 import aiohttp
 import datetime
+from dataclasses import dataclass
 from typing import Tuple, Dict, List, Optional, Any
 from collections import defaultdict
 
@@ -19,7 +20,7 @@ from .entity_refinement import filter_irrelevant_entities, rerank_and_filter_doc
 from .vector_index import build_vector_index, query_vector_index
 from .logger_helper import log_to_file
 
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 
 # Import weather-related functions from the weather module
 # This comment is to warn future developers that these functions should be 
@@ -30,65 +31,100 @@ def get_ha_states(hass):
     """
     Retrieve the full list of Home Assistant device states that are exposed to the assistant.
     It checks for the attribute "conversation_exposed" on each state; if missing, defaults to True.
+    "attributes" is the state's own ReadOnlyDict, shared rather than copied, so treat it as read-only.
     """
-    devices = []
-    for state in hass.states.all():
-        exposed = state.attributes.get("conversation_exposed", True)
-        # log_to_file(f"[DataSources] Device: {state.entity_id}, exposed: {exposed}")
-        # log_to_file(f"[DataSources] RAW: {state}")
-        # Only include devices that are exposed
-        if exposed:
-            devices.append({
-                "entity_id": state.entity_id,
-                "name": state.name,
-                # "state": state.state,
-                "attributes": state.attributes,
-                # "exposed": exposed
-                "domain": state.domain
-                # "object_id": state.object_id
-            })
+    # Only include devices that are exposed. Called from the executor, so this
+    # uses the thread-safe states.all() rather than async_all().
+    devices = [
+        {
+            "entity_id": state.entity_id,
+            "name": state.name,
+            "attributes": state.attributes,
+            "domain": state.domain,
+        }
+        for state in hass.states.all()
+        if state.attributes.get("conversation_exposed", True)
+    ]
     log_to_file(f"[DataSources] Retrieved {len(devices)} exposed HA device states.")
     return devices
 
-def execute_ha_command(command, hass=None):
+async def execute_ha_command_async(command, hass=None):
     """
-    Actually call hass.services.call if it's a dict with 'service' and 'data'.
+    Call hass.services.async_call if it's a dict with 'service' and 'data'.
     Otherwise, log and do nothing.
     """
     log_to_file(f"[DataSources] Executing command: {command}")
 
-    # return True
-    
-    if isinstance(command, dict) and "service" in command and "data" in command:
-        # Example: command["service"] = "light.turn_on"
-        #          command["data"] = {"entity_id": "light.office_outdoor_spotlight_right", "xy_color": [0.55, 0.41]}
-        service_parts = command["service"].split(".")
-        if len(service_parts) == 2:
-            domain, service_name = service_parts
-
-            if hass is None:
-                log_to_file("[execute_ha_command] Error: No hass instance provided.")
-                return False
-
-            try:
-                # Call the Home Assistant service
-                hass.services.call(domain, service_name, command["data"], blocking=True)
-                log_to_file(f"[execute_ha_command] Called service {domain}.{service_name} with {command['data']}")
-                return True
-            except Exception as e:
-                log_to_file(f"[execute_ha_command] Error calling {domain}.{service_name}: {str(e)}")
-                return False
-        else:
-            log_to_file(f"[execute_ha_command] Invalid service format: {command['service']}")
-            return False
-    else:
+    if not (isinstance(command, dict) and "service" in command and "data" in command):
         log_to_file(f"[execute_ha_command] Command not recognized format: {command}")
         return False
 
+    domain, sep, service_name = command["service"].partition(".")
+    if not sep or "." in service_name:
+        log_to_file(f"[execute_ha_command] Invalid service format: {command['service']}")
+        return False
+
+    if hass is None:
+        log_to_file("[execute_ha_command] Error: No hass instance provided.")
+        return False
+
+    try:
+        await hass.services.async_call(domain, service_name, command["data"], blocking=True)
+        log_to_file(f"[execute_ha_command] Called service {domain}.{service_name} with {command['data']}")
+        return True
+    except Exception as e:
+        log_to_file(f"[execute_ha_command] Error calling {domain}.{service_name}: {str(e)}")
+        return False
+
 
 _LOGGER = logging.getLogger(__name__)
 
-async def get_devices_by_area(hass: HomeAssistant) -> Tuple[Dict, List[Dict]]:
+# Key in hass.data holding get_devices_by_area's last result. Registry
+# update events bump its version, which invalidates the cached result.
+DEVICES_CACHE_KEY = "special_agent_devices_by_area"
+
+@callback
+def async_setup_devices_cache(hass, entry):
+    """
+    Create the get_devices_by_area cache for a config entry. The registry
+    listeners and the cache itself go away when the entry is unloaded.
+    """
+    cache = hass.data[DEVICES_CACHE_KEY] = {"version": 0, "key": None, "result": None}
+
+    @callback
+    def _invalidate(event):
+        cache["version"] += 1
+
+    for event_type in (
+        dr.EVENT_DEVICE_REGISTRY_UPDATED,
+        ar.EVENT_AREA_REGISTRY_UPDATED,
+        er.EVENT_ENTITY_REGISTRY_UPDATED,
+    ):
+        entry.async_on_unload(hass.bus.async_listen(event_type, _invalidate))
+
+    @callback
+    def _drop_cache():
+        hass.data.pop(DEVICES_CACHE_KEY, None)
+
+    entry.async_on_unload(_drop_cache)
+
+def _copy_devices_result(result):
+    # The records are frozen; only the containers need copying so callers
+    # can't change the cached result.
+    summary_dict, devices_detail_list = result
+    return {area: dict(counts) for area, counts in summary_dict.items()}, list(devices_detail_list)
+
+@dataclass(frozen=True, slots=True)
+class DeviceInfo:
+    """One device from get_devices_by_area. orjson serializes it as a plain object."""
+    id: str
+    name: str
+    area: Optional[str]
+    domains: Tuple[str, ...]
+    manufacturer: Optional[str]
+    model: Optional[str]
+
+async def get_devices_by_area(hass: HomeAssistant) -> Tuple[Dict, List[DeviceInfo]]:
     """
     Retrieves devices from the HA device registry, along with
     their assigned areas and associated entity domains.
@@ -101,16 +137,16 @@ async def get_devices_by_area(hass: HomeAssistant) -> Tuple[Dict, List[Dict]]:
           ...
         }
 
-      devices_detail_list: A list of device details, for each device:
+      devices_detail_list: A list of DeviceInfo, for each device:
         [
-          {
-            "id": "abcd1234",
-            "name": "Kitchen Ceiling Light",
-            "area": "Kitchen",
-            "domains": ["light"],
-            "manufacturer": "...",
-            "model": "..."
-          },
+          DeviceInfo(
+            id="abcd1234",
+            name="Kitchen Ceiling Light",
+            area="Kitchen",
+            domains=("light",),
+            manufacturer="...",
+            model="..."
+          ),
           ...
         ]
     """
@@ -118,56 +154,82 @@ async def get_devices_by_area(hass: HomeAssistant) -> Tuple[Dict, List[Dict]]:
     device_reg = dr.async_get(hass)
     entity_reg = er.async_get(hass)
 
-    # area_id -> area_name
-    area_map = {area.id: area.name for area in area_reg.areas.values()}
-
     # For convenience
     devices = device_reg.devices  # dict: device_id -> DeviceEntry
     entities = entity_reg.entities  # dict: entity_id -> EntityEntry
 
-    # Build device_id -> list of entity entries
-    device_entities_map = defaultdict(list)
-    for entity_entry in entities.values():
-        if entity_entry.device_id:
-            device_entities_map[entity_entry.device_id].append(entity_entry)
+    # The registries rarely change between calls, so reuse the last result
+    # until an update event (or a size change) says otherwise. Without a
+    # loaded entry there's no cache and the result is always rebuilt.
+    cache = hass.data.get(DEVICES_CACHE_KEY)
+    if cache is not None:
+        cache_key = (cache["version"], len(devices), len(entities), len(area_reg.areas))
+        if cache["key"] == cache_key:
+            return _copy_devices_result(cache["result"])
 
+    # area_id -> area_name
+    area_map = {area.id: area.name for area in area_reg.areas.values()}
+
+    # device_id -> list of entity entries. The registry keeps its own index
+    # by device; only older HA versions without it need the full scan.
+    entries_for_device = getattr(entities, "get_entries_for_device_id", None)
+    if entries_for_device is None:
+        device_entities_map = defaultdict(list)
+        for entity_entry in entities.values():
+            if entity_entry.device_id:
+                device_entities_map[entity_entry.device_id].append(entity_entry)
+        entries_for_device = lambda device_id, include_disabled_entities: device_entities_map[device_id]
 
-    summary_dict = defaultdict(lambda: defaultdict(int))
-    devices_detail_list = []
-    
-    
-# Weather-related functions have been moved to the weather.py module
-# These import statements exist to maintain backward compatibility
-# New code should import directly from the weather module
 
-    for device_id, device_entry in devices.items():
-        area_name = area_map.get(device_entry.area_id, "Unassigned")
+    # Filled in per area below, at each device's registry position
+    devices_detail_list = [None] * len(devices)
+    # Grouped by area_id so each area name is looked up once, not per device
+    devices_by_area = {}  # area_id -> [(position, device_id, device_entry, domains)]
+    counts_by_area = {}   # area_id -> {domain: count}
 
+    for position, (device_id, device_entry) in enumerate(devices.items()):
         # Collect all domains found for the entity(ies) of this device
-        domains_found = set()
-        for ent in device_entities_map[device_id]:
-            domain = ent.entity_id.split(".")[0]  # "light.kitchen_ceiling" => "light"
-            domains_found.add(domain)
-
-        # Create a device details dict
-        device_info = {
-            "id": device_id,
-            "name": device_entry.name or f"Device {device_id}",
-            "area": area_name,
-            "domains": list(domains_found),
-            "manufacturer": device_entry.manufacturer,
-            "model": device_entry.model,
-        }
-        devices_detail_list.append(device_info)
+        # EntityEntry.domain is precomputed by the registry ("light.kitchen_ceiling" => "light")
+        domains_found = {ent.domain for ent in entries_for_device(device_id, include_disabled_entities=True)}
+        devices_by_area.setdefault(device_entry.area_id, []).append(
+            (position, device_id, device_entry, domains_found)
+        )
 
         # For each domain on this device, increment the count
-        for d in domains_found:
-            summary_dict[area_name][d] += 1
-
-    # Convert nested defaultdicts to normal dicts
-    summary_dict = {area: dict(domains) for area, domains in summary_dict.items()}
-
-    return summary_dict, devices_detail_list
+        if domains_found:
+            counts = counts_by_area.setdefault(device_entry.area_id, {})
+            for d in domains_found:
+                counts[d] = counts.get(d, 0) + 1
+
+    for area_id, area_devices in devices_by_area.items():
+        area_name = area_map.get(area_id, "Unassigned")
+        for position, device_id, device_entry, domains_found in area_devices:
+            devices_detail_list[position] = DeviceInfo(
+                id=device_id,
+                name=device_entry.name or f"Device {device_id}",
+                area=area_name,
+                domains=tuple(domains_found),
+                manufacturer=device_entry.manufacturer,
+                model=device_entry.model,
+            )
+
+    summary_dict = {}
+    for area_id, counts in counts_by_area.items():
+        area_name = area_map.get(area_id, "Unassigned")
+        merged = summary_dict.get(area_name)
+        if merged is None:
+            summary_dict[area_name] = counts
+        else:
+            # Several area ids can share a name (e.g. unknown ids => "Unassigned")
+            for d, n in counts.items():
+                merged[d] = merged.get(d, 0) + n
+
+    result = (summary_dict, devices_detail_list)
+    if cache is not None:
+        cache["key"] = cache_key
+        cache["result"] = result
+        return _copy_devices_result(result)
+    return result
 
 # async def async_rebuild_database(hass: HomeAssistant):
 #     """
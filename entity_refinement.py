@@ -238,9 +238,8 @@ def extract_domain(doc: dict) -> str:
         return meta["domain"]
 
     ent_id = meta.get("entity_id", "")
-    if "." in ent_id:
-        return ent_id.split(".")[0]
-    return "unknown"
+    domain, sep, _ = ent_id.partition(".")
+    return domain if sep else "unknown"
 
 
 
@@ -1,7 +1,43 @@
+from functools import lru_cache
 from openai import OpenAI
 import json
+import re
 from .logger_helper import log_to_file
 
+# Every intent classify_intent / classify_and_refine may return.
+INTENTS = ["control", "question", "weather", "test", "rebuild_database"]
+
+# Intent classify_and_refine returns without an API key, when the GPT call
+# fails, or when GPT answers with something outside INTENTS.
+FALLBACK_INTENT = "control"
+
+# Unambiguous phrasings that can be routed without asking GPT. Only weather
+# questions are matched, so "turn off the weather station display" still
+# goes to GPT as control. Rebuilds are expensive and always go through GPT.
+FAST_INTENT_PATTERNS = [
+    (re.compile(
+        r"^\s*(?:what|how)(?:'s|\s+is|\s+will)\b.*\b(?:weather|forecast)\b"
+        r"|\b(?:weather|forecast)\s+(?:in|for|today|tomorrow|like)\b",
+        re.IGNORECASE,
+    ), "weather"),
+]
+
+@lru_cache(maxsize=4)
+def get_openai_client(api_key):
+    """
+    Return a shared OpenAI client for api_key. The client keeps its HTTP
+    connection pool, so calls after the first skip the TCP/TLS handshake.
+    """
+    return OpenAI(api_key=api_key)
+
+def _log_cached_tokens(name, completion):
+    """Log how much of the prompt OpenAI served from its prompt-prefix cache."""
+    usage = getattr(completion, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None)
+    if cached is not None:
+        log_to_file(f"[GPTCommands] {name} prompt tokens: {usage.prompt_tokens}, cached: {cached}")
+
 def generate_user_friendly_confirmation(user_text, commands_list, api_key=None):
     """
     Generate a user-friendly confirmation message for the voice assistant to speak.
@@ -85,7 +121,7 @@ def generate_user_friendly_confirmation(user_text, commands_list, api_key=None):
         """
         
         # Make the API call
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key)
         completion = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
@@ -132,7 +168,6 @@ def generate_weather_response(user_text, local_sensors, online_weather, location
     try:
         # First, let's check if this is a query about weather in a different location
         # Simple location detection in the query
-        import re
         location_query = None
         location_patterns = [
             r"(?:in|at|for|of)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+){0,2})",  # "weather in San Francisco"
@@ -162,10 +197,10 @@ def generate_weather_response(user_text, local_sensors, online_weather, location
         if online_weather and "data" in online_weather:
             log_to_file(f"[GPTCommands] Online weather data found")
         
-        # Convert Python objects to strings for the prompt
-        local_json = json.dumps(local_sensors, indent=2)
-        online_json = json.dumps(online_weather, indent=2)
-        location_json = json.dumps(location_info, indent=2)
+        # Convert Python objects to compact strings for the prompt
+        local_json = json.dumps(local_sensors, separators=(",", ":"))
+        online_json = json.dumps(online_weather, separators=(",", ":"))
+        location_json = json.dumps(location_info, separators=(",", ":"))
         
         # Create a prompt for the LLM
         system_prompt = """
@@ -232,7 +267,7 @@ def generate_weather_response(user_text, local_sensors, online_weather, location
         log_to_file(f"[GPTCommands] Weather user prompt: {user_prompt}")
         
         # Call the OpenAI API
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key)
         completion = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
@@ -258,7 +293,7 @@ def classify_intent(user_text, api_key=None):
     """
     if api_key:
         try:
-            client = OpenAI(api_key=api_key)
+            client = get_openai_client(api_key)
             system_prompt = (
                 "Analyze the following user text. "
                 "Return exactly one of these words in lowercase: 'control', 'question', 'weather', 'rebuild_database', 'test'. "
@@ -275,7 +310,7 @@ def classify_intent(user_text, api_key=None):
             classification = completion.choices[0].message.content.strip().lower()
             log_to_file(f"[GPTCommands] classify_intent => {classification}")
             # validate
-            if classification not in ["control", "question", "weather", "test", "rebuild_database"]:
+            if classification not in INTENTS:
                 classification = "test"
             return classification
         except Exception as e:
@@ -293,6 +328,81 @@ def classify_intent(user_text, api_key=None):
         return "control"
 
 
+def fast_classify(user_text):
+    """
+    Return the intent for obvious requests (weather questions) from a
+    keyword match, or None if GPT needs to classify it.
+    """
+    for pattern, intent in FAST_INTENT_PATTERNS:
+        if pattern.search(user_text):
+            log_to_file(f"[GPTCommands] fast_classify => {intent}")
+            return intent
+    return None
+
+def classify_and_refine(user_text, api_key=None):
+    """
+    One structured-JSON call replacing classify_intent, ask_gpt_for_refined_query,
+    ask_gpt_if_user_wants_music and ask_gpt_for_spotify_query. Returns a dict:
+
+      {"intent": str, "refined_query": str, "wants_music": bool, "spotify_query": str}
+
+    Falls back to FALLBACK_INTENT and the unrefined text on error.
+    """
+    result = {
+        "intent": FALLBACK_INTENT,
+        "refined_query": user_text,
+        "wants_music": False,
+        "spotify_query": user_text,
+    }
+    if not api_key:
+        return result
+
+    system_prompt = (
+        "Analyze the user's smart home request and return a JSON object with exactly these keys:\n"
+        '"intent": exactly one of "control", "question", "weather", "rebuild_database", "test".\n'
+        '"refined_query": the essential keywords to find relevant devices with keyword search. '
+        "The most important keyword to search for is room name (office, living room, dining room, bedroom, kitchen). "
+        "Do not include adjectives, focus on nouns. "
+        "Focus on device type (light, fan, media_player, climate, switch). "
+        "If user is being vague describing a scene then provide keywords "
+        "which could achieve the intent of the user. A short phrase in lowercase.\n"
+        '"wants_music": true if the command implies or would benefit from playing music, otherwise false.\n'
+        '"spotify_query": if wants_music, a concise Spotify search query using only \'track:\', \'album:\', or \'playlist:\' '
+        "field filters as needed. Never return an artist, instead if the user wants music from a specific artist find a playlist or album, "
+        "unless the user requests a specific song from that artist then the artist should a filter and not the primary search term. "
+        'Otherwise an empty string.\n'
+        "Return only the JSON object."
+    )
+    try:
+        client = get_openai_client(api_key)
+        completion = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_text}
+            ],
+            temperature=0.0,
+            response_format={"type": "json_object"},
+        )
+        parsed = json.loads(completion.choices[0].message.content)
+        log_to_file(f"[GPTCommands] classify_and_refine => {parsed}")
+    except Exception as e:
+        log_to_file(f"[GPTCommands] classify_and_refine error: {e}. Using defaults.")
+        return result
+
+    intent = str(parsed.get("intent", "")).strip().lower()
+    result["intent"] = intent if intent in INTENTS else FALLBACK_INTENT
+    refined = str(parsed.get("refined_query") or "").strip().lower()
+    if refined:
+        result["refined_query"] = refined
+    wants_music = parsed.get("wants_music", False)
+    result["wants_music"] = wants_music is True or str(wants_music).strip().lower() == "true"
+    spotify_query = str(parsed.get("spotify_query") or "").strip()
+    if spotify_query:
+        result["spotify_query"] = spotify_query
+    return result
+
+
 def ask_gpt_for_refined_query(user_text, api_key=None):
     """
     Given the user text, extract keywords or short phrase to help with vector search.
@@ -300,7 +410,7 @@ def ask_gpt_for_refined_query(user_text, api_key=None):
     """
     if api_key:
         try:
-            client = OpenAI(api_key=api_key)
+            client = get_openai_client(api_key)
             system_prompt = (
                 "Extract the essential keywords from the user's request to find relevant devices with keyword search. "
                 "The most important keyword to search for is room name (office, living room, dining room, bedroom, kitchen). "
@@ -333,7 +443,7 @@ def ask_gpt_if_user_wants_music(user_text, api_key=None):
     """
     if api_key:
         try:
-            client = OpenAI(api_key=api_key)
+            client = get_openai_client(api_key)
             system_prompt = (
                 "Decide if the user's command implies or would benefit from playing music. "
                 "Return 'true' or 'false' only, no extra text."
@@ -370,7 +480,7 @@ def ask_gpt_for_spotify_query(prompt, api_key=None):
     """
     if api_key:
         try:
-            client = OpenAI(api_key=api_key)
+            client = get_openai_client(api_key)
             messages = [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
@@ -410,11 +520,13 @@ def ask_gpt_for_rest_command(user_text, context, api_key=None):
         # fallback: just return empty JSON
         return "[]"
 
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key)
+    # Keep the system prompt identical on every call and send the per-request
+    # device context after it, so OpenAI's automatic prompt-prefix caching
+    # can reuse the prefill for the static part.
     system_prompt = (
         "You are a Home Assistant command generator. "
-        "The user wants to perform some action. We also have the following device info:\n"
-        f"{context}\n"
+        "The user wants to perform some action. The device info is provided in the next message.\n"
         "Output a JSON array of commands. Always return an array even if there is only 1 item. "
         "Each command is an object see example of desired output below:\n"
         '[\n'
@@ -442,9 +554,10 @@ def ask_gpt_for_rest_command(user_text, context, api_key=None):
         "IMPORTANT: Return ONLY valid JSON, no extra text or code fences or commented out text."
     )
     # system_prompt = (f"Name all the types of devices shared: {context}")
-    log_to_file(f"[GPTCommands] system prompt: {system_prompt}")
+    log_to_file(f"[GPTCommands] device context: {context}")
     messages = [
         {"role": "system", "content": system_prompt},
+        {"role": "system", "content": f"Device info:\n{context}"},
         {"role": "user", "content": user_text}
     ]
     # log_to_file(f"[GPTCommands] messages: {messages}")
@@ -462,6 +575,7 @@ def ask_gpt_for_rest_command(user_text, context, api_key=None):
         
         commands_json = completion.choices[0].message.content.strip()
         log_to_file(f"[GPTCommands] ask_gpt_for_rest_command => {commands_json}")
+        _log_cached_tokens("ask_gpt_for_rest_command", completion)
         return commands_json
     except Exception as e:
         log_to_file(f"[GPTCommands] ask_gpt_for_rest_command error => {e}")
@@ -1,6 +1,8 @@
-import asyncio
+import logging
 import os
+import queue
 import sys
+import threading
 
 # Get the directory where the current file (logger_helper.py) is located
 COMPONENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -9,31 +11,96 @@ LOG_FILE = os.path.join(COMPONENT_DIR, "special_agent_log.txt")
 # Check if we're running in a test environment
 IN_TESTING = os.environ.get('SPECIAL_AGENT_TESTING') == 'true'
 
-def log_to_file(message):
+_LOGGER = logging.getLogger(__name__)
+
+# File logging can be switched off with SPECIAL_AGENT_LOG=false; log_to_file
+# then returns straight away.
+LOG_ENABLED = os.environ.get('SPECIAL_AGENT_LOG', 'true').lower() != 'false'
+
+# Max number of queued messages joined into a single write.
+LOG_BATCH_SIZE = 32
+
+# Buffer size of the log file handle held open by the writer thread.
+LOG_BUFFER_SIZE = 8192
+
+# Messages are handed to a single writer thread so callers (event loop or
+# executor threads alike) never touch the disk themselves.
+_log_queue = queue.SimpleQueue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+def log_to_file(message, *args):
+    """
+    Queue a message for the log file. Like logging, '%' args are only
+    interpolated later by the writer thread, so callers on the hot path can
+    pass log_to_file("... %s", value) instead of building an f-string.
+    """
+    if not LOG_ENABLED:
+        return
+
     # When testing, just print to stdout instead of file operations
     if IN_TESTING:
-        print(f"[LOG] {message}")
+        print(f"[LOG] {_format(message, args)}")
         return
-        
+
+    if _writer_thread is None:
+        _start_writer()
+    _log_queue.put_nowait((message, args))
+
+def _format(message, args):
+    if not args:
+        return message
     try:
-        # Try to get the current running event loop.
-        loop = asyncio.get_running_loop()
-        # Schedule asynchronous logging.
-        loop.create_task(_async_log(message))
-    except RuntimeError:
-        # No running event loop, fallback to synchronous logging.
-        _sync_log(message)
-
-async def _async_log(message):
-    await asyncio.to_thread(_sync_log, message)
-
-def _sync_log(message):
+        return message % args
+    except (TypeError, ValueError):
+        # Never let a bad format string kill the writer thread.
+        return f"{message} {args!r}"
+
+def _start_writer():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(
+                target=_writer_loop, name="special_agent_log", daemon=True
+            )
+            _writer_thread.start()
+
+def _writer_loop():
+    # The log file stays open for the life of the thread; writes go through
+    # its buffer and are flushed whenever the queue runs dry.
+    logfile = None
+    while True:
+        # Block for the first message, then drain whatever else is queued.
+        batch = [_log_queue.get()]
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        text = "\n".join(_format(message, args) for message, args in batch) + "\n"
+        try:
+            if logfile is None:
+                logfile = open(LOG_FILE, "a", buffering=LOG_BUFFER_SIZE)
+            logfile.write(text)
+            if _log_queue.empty():
+                logfile.flush()
+        except Exception as e:
+            if logfile is not None:
+                try:
+                    logfile.close()
+                except Exception:
+                    pass
+                logfile = None
+            _fallback_log(text, e)
+
+def _fallback_log(text, error):
+    # Fallback if we can't write to the component directory. Must never
+    # raise: an exception here would kill the writer thread and leave the
+    # queue growing forever.
+    _LOGGER.warning("Error writing to log: %s", error)
     try:
-        with open(LOG_FILE, "a") as logfile:
-            logfile.write(message + "\n")
-    except Exception as e:
-        # Fallback if we can't write to the component directory
-        print(f"Error writing to log: {e}")
         with open("/tmp/special_agent_log.txt", "a") as logfile:
-            logfile.write(f"Original error: {e}\n")
-            logfile.write(message + "\n")
+            logfile.write(f"Original error: {error}\n")
+            logfile.write(text)
+    except Exception as e:
+        _LOGGER.warning("Error writing to fallback log, dropping messages: %s", e)
@@ -0,0 +1,138 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Keys in hass.data where the retrieval caches live.
+SEMCACHE_KEY = "special_agent_semcache"
+RAG_CACHE_KEY = "special_agent_rag_cache"
+
+class SmartRAGCache:
+    """
+    Exact-match LRU + TTL cache of retrieval results keyed on the normalized
+    refined query and the index version, so it's checked before any
+    embedding call and a rebuild implicitly invalidates every entry.
+    """
+
+    def __init__(self, capacity=256, ttl=600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text, index_version):
+        normalized = " ".join(text.lower().split())
+        return hashlib.blake2b(f"{index_version}:{normalized}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class SemanticCache:
+    """
+    Approximate cache of retrieval results keyed on normalized query embeddings.
+
+    lookup() returns the value stored for the most similar previous query when
+    its cosine similarity is >= threshold, so near-duplicate requests skip the
+    vector search and re-rank. Holds at most `capacity` entries; the least
+    recently used one is overwritten once full.
+    """
+
+    def __init__(self, threshold=0.92, capacity=512):
+        self.threshold = threshold
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Drop every cached entry (e.g. after the vector index is rebuilt)."""
+        with self._lock:
+            self._keys = None  # (capacity, dim) float32, first _size rows used
+            self._values = []
+            self._last_used = []
+            self._size = 0
+            self._tick = 0
+
+    def __len__(self):
+        return self._size
+
+    def lookup(self, query_vec):
+        """Return the cached value for the closest query above threshold, or None."""
+        with self._lock:
+            if self._size == 0 or self._keys.shape[1] != query_vec.shape[0]:
+                return None
+            scores = self._keys[:self._size] @ query_vec
+            idx = int(np.argmax(scores))
+            if scores[idx] < self.threshold:
+                return None
+            self._tick += 1
+            self._last_used[idx] = self._tick
+            return self._values[idx]
+
+    def add(self, query_vec, value):
+        """Cache value under query_vec, evicting the least recently used entry if full."""
+        with self._lock:
+            if self._keys is None or self._keys.shape[1] != query_vec.shape[0]:
+                # First entry, or the embedding model changed: start over.
+                self._keys = np.empty((self.capacity, query_vec.shape[0]), dtype=np.float32)
+                self._values = []
+                self._last_used = []
+                self._size = 0
+
+            if self._size < self.capacity:
+                idx = self._size
+                self._size += 1
+                self._values.append(value)
+                self._last_used.append(0)
+            else:
+                idx = min(range(self._size), key=self._last_used.__getitem__)
+                self._values[idx] = value
+
+            self._keys[idx] = query_vec
+            self._tick += 1
+            self._last_used[idx] = self._tick
+
+def get_rag_cache(hass):
+    """Return the SmartRAGCache stored in hass.data, creating it on first use."""
+    cache = hass.data.get(RAG_CACHE_KEY)
+    if cache is None:
+        cache = hass.data[RAG_CACHE_KEY] = SmartRAGCache()
+    return cache
+
+def get_semantic_cache(hass):
+    """Return the SemanticCache stored in hass.data, creating it on first use."""
+    cache = hass.data.get(SEMCACHE_KEY)
+    if cache is None:
+        cache = hass.data[SEMCACHE_KEY] = SemanticCache()
+    return cache
+
+def clear_semantic_cache(hass):
+    """Invalidate cached retrieval results, e.g. after the device index changed."""
+    cache = hass.data.get(SEMCACHE_KEY)
+    if cache is not None:
+        cache.clear()
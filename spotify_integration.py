@@ -1,6 +1,8 @@
 import time
 import re
+import aiohttp
 import requests
+from homeassistant.helpers import aiohttp_client
 from .logger_helper import log_to_file
 
 SPOTIFY_API_BASE_URL = "https://api.spotify.com/v1"
@@ -14,43 +16,80 @@ SPOTIFY_SEARCH_TYPE_KEY_MAP = {
     "playlist": "playlists"
 }
 
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+SPOTIFY_TOKEN_HEADERS = {"Content-Type": "application/x-www-form-urlencoded; charset=utf-8"}
+SPOTIFY_TOKEN_DATA = {"grant_type": "client_credentials"}
+
+# Timeout for each request on HA's shared session, so a hung call can't
+# stall a control turn
+SPOTIFY_HTTP_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+def _get_cached_token(refresh_margin):
+    """Return the cached access token if it's still valid for refresh_margin seconds."""
+    if (spotify_token_cache.get("access_token") and
+            time.time() < spotify_token_cache["expiration_time"] - refresh_margin):
+        log_to_file("[Spotify] Using cached access token.")
+        return spotify_token_cache["access_token"]
+    return None
+
+def _store_token(token_info, requested_at):
+    access_token = token_info["access_token"]
+    expires_in = token_info["expires_in"]
+    spotify_token_cache["access_token"] = access_token
+    spotify_token_cache["expiration_time"] = requested_at + expires_in
+    log_to_file(f"[Spotify] Access token obtained, expires in {expires_in} seconds.")
+    return access_token
+
 def get_spotify_access_token(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, refresh_margin=60):
     """
     Retrieve a Spotify access token using the Client Credentials flow.
     Caches the token to avoid repeated calls.
     """
-    global spotify_token_cache
     current_time = time.time()
     
     log_to_file(f"[Spotify] Client ID length: {len(SPOTIFY_CLIENT_ID.strip())}, Secret length: {len(SPOTIFY_CLIENT_SECRET.strip())}")
     
-    if (spotify_token_cache.get("access_token") and 
-            current_time < spotify_token_cache["expiration_time"] - refresh_margin):
-        log_to_file("[Spotify] Using cached access token.")
-        return spotify_token_cache["access_token"]
+    cached = _get_cached_token(refresh_margin)
+    if cached:
+        return cached
 
-    token_url = "https://accounts.spotify.com/api/token"
-    headers = {"Content-Type": "application/x-www-form-urlencoded; charset=utf-8"}
-    data = {"grant_type": "client_credentials"}
     log_to_file("[Spotify] Requesting new access token.")
     
-    response = requests.post(token_url,
+    response = requests.post(SPOTIFY_TOKEN_URL,
                              auth=(SPOTIFY_CLIENT_ID.strip(), SPOTIFY_CLIENT_SECRET.strip()),
-                             headers=headers,
-                             data=data)
+                             headers=SPOTIFY_TOKEN_HEADERS,
+                             data=SPOTIFY_TOKEN_DATA)
     
     if response.status_code == 200:
-        token_info = response.json()
-        access_token = token_info["access_token"]
-        expires_in = token_info["expires_in"]
-        spotify_token_cache["access_token"] = access_token
-        spotify_token_cache["expiration_time"] = current_time + expires_in
-        log_to_file(f"[Spotify] Access token obtained, expires in {expires_in} seconds.")
-        return access_token
+        return _store_token(response.json(), current_time)
     else:
         log_to_file(f"[Spotify] Error obtaining token: {response.status_code} - {response.text}")
         return None
 
+async def get_spotify_access_token_async(hass, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, refresh_margin=60):
+    """
+    Async counterpart of get_spotify_access_token for use on the event loop.
+    Uses Home Assistant's shared aiohttp session, so the connection to Spotify
+    is pooled instead of tying up an executor thread per request.
+    """
+    current_time = time.time()
+
+    cached = _get_cached_token(refresh_margin)
+    if cached:
+        return cached
+
+    log_to_file("[Spotify] Requesting new access token.")
+    session = aiohttp_client.async_get_clientsession(hass)
+    async with session.post(SPOTIFY_TOKEN_URL,
+                            auth=aiohttp.BasicAuth(SPOTIFY_CLIENT_ID.strip(), SPOTIFY_CLIENT_SECRET.strip()),
+                            headers=SPOTIFY_TOKEN_HEADERS,
+                            data=SPOTIFY_TOKEN_DATA,
+                            timeout=SPOTIFY_HTTP_TIMEOUT) as response:
+        if response.status == 200:
+            return _store_token(await response.json(), current_time)
+        log_to_file(f"[Spotify] Error obtaining token: {response.status} - {await response.text()}")
+        return None
+
 def parse_spotify_query(llm_query):
     """
     Parse the LLM-generated query to extract the intended type and return a tuple:
@@ -92,29 +131,7 @@ def search_spotify(access_token, llm_query, limit=1, market="US"):
     
     
     if response.status_code == 200:
-        search_results = response.json()
-        log_to_file(f"[Spotify] Full query response: {search_results}")
-        log_to_file(f"[Spotify] Top-level keys in response: {list(search_results.keys())}")
-        plural_key = SPOTIFY_SEARCH_TYPE_KEY_MAP.get(search_type, search_type + "s")
-        if plural_key in search_results:
-            items = search_results[plural_key].get("items", [])
-            if not items:
-                # No items at all
-                log_to_file(f"[Spotify] No items found for {search_type}")
-                return None
-            
-            # Make sure the first item is not None
-            first_item = items[0]
-            if first_item is None:
-                log_to_file(f"[Spotify] First item is None for {search_type} query {query}.")
-                return None
-            
-            uri = first_item.get("uri")
-            log_to_file(f"[Spotify] Found {search_type} URI: {uri}")
-            return uri
-        else:
-            log_to_file(f"[Spotify] No matching items found for type '{search_type}' with query '{query}'.")
-            return None
+        return _first_uri(response.json(), search_type, query)
 
         # plural_key = SPOTIFY_SEARCH_TYPE_KEY_MAP.get(search_type, search_type + "s")
         # if plural_key in search_results and search_results[plural_key]["items"]:
@@ -129,6 +146,52 @@ def search_spotify(access_token, llm_query, limit=1, market="US"):
         log_to_file(f"[Spotify] Error searching Spotify: {response.status_code} - {response.text}")
         return None
 
+async def search_spotify_async(hass, access_token, llm_query, limit=1, market="US"):
+    """
+    Async counterpart of search_spotify, using Home Assistant's shared aiohttp session.
+    """
+    search_type, query = parse_spotify_query(llm_query)
+    headers = {"Authorization": f"Bearer {access_token}"}
+    params = {
+        "q": query,
+        "type": search_type,
+        "limit": limit,
+        "market": market
+    }
+    log_to_file(f"[Spotify] Searching for query: {params}")
+    session = aiohttp_client.async_get_clientsession(hass)
+    async with session.get(f"{SPOTIFY_API_BASE_URL}/search", headers=headers, params=params,
+                           timeout=SPOTIFY_HTTP_TIMEOUT) as response:
+        if response.status == 200:
+            return _first_uri(await response.json(), search_type, query)
+        log_to_file(f"[Spotify] Error searching Spotify: {response.status} - {await response.text()}")
+        return None
+
+def _first_uri(search_results, search_type, query):
+    """Return the URI of the first item of search_type in a search response, or None."""
+    log_to_file(f"[Spotify] Full query response: {search_results}")
+    log_to_file(f"[Spotify] Top-level keys in response: {list(search_results.keys())}")
+    plural_key = SPOTIFY_SEARCH_TYPE_KEY_MAP.get(search_type, search_type + "s")
+    if plural_key in search_results:
+        items = search_results[plural_key].get("items", [])
+        if not items:
+            # No items at all
+            log_to_file(f"[Spotify] No items found for {search_type}")
+            return None
+        
+        # Make sure the first item is not None
+        first_item = items[0]
+        if first_item is None:
+            log_to_file(f"[Spotify] First item is None for {search_type} query {query}.")
+            return None
+        
+        uri = first_item.get("uri")
+        log_to_file(f"[Spotify] Found {search_type} URI: {uri}")
+        return uri
+    else:
+        log_to_file(f"[Spotify] No matching items found for type '{search_type}' with query '{query}'.")
+        return None
+
 
 
 
@@ -2,29 +2,46 @@
 Tests for command_history.py functionality
 """
 import unittest
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch
 import json
 import sys
 import os
+import tempfile
 
 # Add parent directory to path so we can import our modules
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import the module to test
+import command_history
 from command_history import log_command
 
 
 class TestCommandHistory(unittest.TestCase):
     """Test cases for command_history.py functions"""
 
-    @patch('command_history.open', new_callable=mock_open, read_data='[]')
-    @patch('command_history.os.path.exists')
-    @patch('command_history.log_to_file')
-    def test_log_command_new_file(self, mock_log, mock_exists, mock_file):
+    def setUp(self):
+        """Point the history file at a temp dir and reset the line counter"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.history_file = os.path.join(self.tmp_dir.name, "command_history.ndjson")
+        patchers = [
+            patch('command_history.HISTORY_FILE', self.history_file),
+            patch('command_history.IN_TESTING', False),
+            patch('command_history._history_count', None),
+            patch('command_history._history_fd', None),
+            patch('command_history.log_to_file'),
+        ]
+        self.addCleanup(self.tmp_dir.cleanup)
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(command_history.close_history)
+
+    def read_history(self):
+        with open(self.history_file, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_log_command_new_file(self):
         """Test logging a command when the history file doesn't exist yet"""
-        # Setup
-        mock_exists.return_value = False
-        
         # Call the function
         log_command(
             user_text="Turn on the lights",
@@ -34,13 +51,8 @@ class TestCommandHistory(unittest.TestCase):
             success=True
         )
         
-        # Assertions
-        mock_file.assert_called()
-        # Get the data written to the file
-        write_call = mock_file().write.call_args[0][0]
-        data = json.loads(write_call)
-        
-        # Verify it's a list with one entry
+        # Verify the file holds one entry
+        data = self.read_history()
         self.assertEqual(len(data), 1)
         self.assertEqual(data[0]["user_text"], "Turn on the lights")
         self.assertEqual(data[0]["device_id"], "device123")
@@ -49,14 +61,11 @@ class TestCommandHistory(unittest.TestCase):
         self.assertEqual(data[0]["success"], True)
         self.assertIn("timestamp", data[0])
 
-    @patch('command_history.open', new_callable=mock_open, 
-           read_data='[{"timestamp": "2023-01-01T00:00:00", "user_text": "Old command"}]')
-    @patch('command_history.os.path.exists')
-    @patch('command_history.log_to_file')
-    def test_log_command_existing_file(self, mock_log, mock_exists, mock_file):
+    def test_log_command_existing_file(self):
         """Test logging a command when the history file already exists"""
         # Setup
-        mock_exists.return_value = True
+        with open(self.history_file, "w", encoding="utf-8") as f:
+            f.write('{"timestamp": "2023-01-01T00:00:00", "user_text": "Old command"}\n')
         
         # Call the function
         log_command(
@@ -65,26 +74,15 @@ class TestCommandHistory(unittest.TestCase):
             metadata={"test": "metadata"}
         )
         
-        # Assertions
-        mock_file.assert_called()
-        # Get the data written to the file
-        write_call = mock_file().write.call_args[0][0]
-        data = json.loads(write_call)
-        
-        # Verify it's a list with two entries (old + new)
+        # Verify it's two entries (old + new)
+        data = self.read_history()
         self.assertEqual(len(data), 2)
         self.assertEqual(data[0]["user_text"], "Old command")
         self.assertEqual(data[1]["user_text"], "New command")
         self.assertEqual(data[1]["metadata"], {"test": "metadata"})
 
-    @patch('command_history.open', new_callable=mock_open)
-    @patch('command_history.os.path.exists')
-    @patch('command_history.log_to_file')
-    def test_log_command_with_commands_list(self, mock_log, mock_exists, mock_file):
+    def test_log_command_with_commands_list(self):
         """Test logging a command with a commands_list included"""
-        # Setup
-        mock_exists.return_value = False
-        
         commands_list = [
             {
                 "service": "light.turn_on",
@@ -103,19 +101,43 @@ class TestCommandHistory(unittest.TestCase):
             success=True
         )
         
-        # Assertions
-        mock_file.assert_called()
-        # Get the data written to the file
-        write_call = mock_file().write.call_args[0][0]
-        data = json.loads(write_call)
-        
         # Verify the commands were simplified and included
+        data = self.read_history()
         self.assertEqual(len(data), 1)
         self.assertIn("commands", data[0])
         self.assertEqual(len(data[0]["commands"]), 1)
         self.assertEqual(data[0]["commands"][0]["service"], "light.turn_on")
         self.assertEqual(data[0]["commands"][0]["entity_id"], "light.living_room")
 
+    def test_log_command_skips_non_dict_commands(self):
+        """Test that entries in commands_list that aren't dicts are skipped"""
+        log_command(
+            user_text="Turn on the lights",
+            commands_list=[{"service": "light.turn_on", "data": {}}, "not a command"],
+            success=True
+        )
+
+        data = self.read_history()
+        self.assertEqual(data[0]["commands"], [{"service": "light.turn_on", "entity_id": "unknown"}])
+
+    def test_log_command_without_valid_commands(self):
+        """Test that no commands key is written when nothing in commands_list is a dict"""
+        log_command(user_text="Turn on the lights", commands_list=["not a command"])
+
+        data = self.read_history()
+        self.assertNotIn("commands", data[0])
+
+    @patch('command_history.ROTATE_SLACK', 2)
+    @patch('command_history.MAX_HISTORY_ENTRIES', 3)
+    def test_log_command_rotation(self):
+        """Test the file is trimmed to the newest entries once it grows too long"""
+        for i in range(6):
+            log_command(user_text=f"command {i}")
+
+        # 6 entries > 3 + 2, so the file was trimmed back to the newest 3
+        data = self.read_history()
+        self.assertEqual([d["user_text"] for d in data], ["command 3", "command 4", "command 5"])
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -12,13 +12,20 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # Import the module to test
 from gpt_commands import (
     classify_intent,
-    generate_user_friendly_confirmation
+    classify_and_refine,
+    fast_classify,
+    generate_user_friendly_confirmation,
+    get_openai_client
 )
 
 
 class TestGptCommands(unittest.TestCase):
     """Test cases for gpt_commands.py functions"""
 
+    def setUp(self):
+        # Each test patches OpenAI, so don't reuse a client from a previous test
+        get_openai_client.cache_clear()
+
     @patch('gpt_commands.OpenAI')
     @patch('gpt_commands.log_to_file')
     def test_classify_intent(self, mock_log, mock_openai):
@@ -57,6 +64,56 @@ class TestGptCommands(unittest.TestCase):
         self.assertEqual(result, "control")
         mock_client.chat.completions.create.assert_called_once()
 
+    @patch('gpt_commands.log_to_file')
+    def test_fast_classify(self, mock_log):
+        """Test obvious requests are classified without GPT"""
+        self.assertEqual(fast_classify("What's the weather like in Boston?"), "weather")
+        self.assertEqual(fast_classify("How is the forecast for tomorrow?"), "weather")
+        self.assertIsNone(fast_classify("Turn off the weather station display"))
+        self.assertIsNone(fast_classify("Please rebuild the database"))
+        self.assertIsNone(fast_classify("Turn on the kitchen lights"))
+
+    @patch('gpt_commands.OpenAI')
+    @patch('gpt_commands.log_to_file')
+    def test_classify_and_refine(self, mock_log, mock_openai):
+        """Test classify_and_refine parses the structured JSON response"""
+        mock_client = MagicMock()
+        mock_openai.return_value = mock_client
+
+        mock_completion = MagicMock()
+        mock_completion.choices = [MagicMock()]
+        mock_completion.choices[0].message.content = (
+            '{"intent": "control", "refined_query": "Office Speaker", '
+            '"wants_music": true, "spotify_query": "playlist:jazz"}'
+        )
+        mock_client.chat.completions.create.return_value = mock_completion
+
+        result = classify_and_refine("Play some jazz in the office", api_key="fake_key")
+
+        self.assertEqual(result, {
+            "intent": "control",
+            "refined_query": "office speaker",
+            "wants_music": True,
+            "spotify_query": "playlist:jazz",
+        })
+        mock_client.chat.completions.create.assert_called_once()
+        _, kwargs = mock_client.chat.completions.create.call_args
+        self.assertEqual(kwargs["response_format"], {"type": "json_object"})
+
+    @patch('gpt_commands.OpenAI')
+    @patch('gpt_commands.log_to_file')
+    def test_classify_and_refine_fallback(self, mock_log, mock_openai):
+        """Test classify_and_refine falls back to defaults on API errors"""
+        mock_client = MagicMock()
+        mock_openai.return_value = mock_client
+        mock_client.chat.completions.create.side_effect = Exception("API Error")
+
+        result = classify_and_refine("Turn on the lights", api_key="fake_key")
+
+        self.assertEqual(result["intent"], "control")
+        self.assertEqual(result["refined_query"], "Turn on the lights")
+        self.assertFalse(result["wants_music"])
+
     @patch('gpt_commands.OpenAI')
     @patch('gpt_commands.log_to_file')
     def test_generate_user_friendly_confirmation(self, mock_log, mock_openai):
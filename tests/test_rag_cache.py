@@ -0,0 +1,104 @@
+"""
+Tests for rag_cache.py functionality
+"""
+import unittest
+from unittest.mock import patch
+import sys
+import os
+
+import numpy as np
+
+# Add parent directory to path so we can import our modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import the module to test
+from rag_cache import SemanticCache, SmartRAGCache
+
+
+def _unit(*values):
+    vec = np.array(values, dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+class TestSemanticCache(unittest.TestCase):
+    """Test cases for the SemanticCache class"""
+
+    def test_hit_above_threshold(self):
+        """A near-duplicate query returns the cached value"""
+        cache = SemanticCache(threshold=0.95)
+        cache.add(_unit(1.0, 0.0, 0.0), ["kitchen docs"])
+
+        self.assertEqual(cache.lookup(_unit(1.0, 0.05, 0.0)), ["kitchen docs"])
+
+    def test_miss_below_threshold(self):
+        """A dissimilar query is a miss"""
+        cache = SemanticCache(threshold=0.95)
+        cache.add(_unit(1.0, 0.0, 0.0), ["kitchen docs"])
+
+        self.assertIsNone(cache.lookup(_unit(0.0, 1.0, 0.0)))
+
+    def test_lru_eviction(self):
+        """Once full, the least recently used entry is replaced"""
+        cache = SemanticCache(threshold=0.99, capacity=2)
+        cache.add(_unit(1.0, 0.0, 0.0), "a")
+        cache.add(_unit(0.0, 1.0, 0.0), "b")
+        cache.lookup(_unit(1.0, 0.0, 0.0))  # "a" is now more recent than "b"
+        cache.add(_unit(0.0, 0.0, 1.0), "c")
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.lookup(_unit(1.0, 0.0, 0.0)), "a")
+        self.assertIsNone(cache.lookup(_unit(0.0, 1.0, 0.0)))
+        self.assertEqual(cache.lookup(_unit(0.0, 0.0, 1.0)), "c")
+
+    def test_clear(self):
+        """clear() drops all entries"""
+        cache = SemanticCache()
+        cache.add(_unit(1.0, 0.0), "a")
+        cache.clear()
+
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.lookup(_unit(1.0, 0.0)))
+
+
+class TestSmartRAGCache(unittest.TestCase):
+    """Test cases for the SmartRAGCache class"""
+
+    def test_key_normalizes_text(self):
+        """Case and whitespace differences map to the same key"""
+        self.assertEqual(
+            SmartRAGCache.make_key("Office  Light", 1),
+            SmartRAGCache.make_key(" office light", 1)
+        )
+
+    def test_key_includes_index_version(self):
+        """A new index version gives a different key"""
+        self.assertNotEqual(
+            SmartRAGCache.make_key("office light", 1),
+            SmartRAGCache.make_key("office light", 2)
+        )
+
+    def test_ttl_expiry(self):
+        """Entries older than the TTL are dropped"""
+        cache = SmartRAGCache(ttl=10)
+        with patch('rag_cache.time.monotonic', return_value=100.0):
+            cache.put("key", ["docs"])
+        with patch('rag_cache.time.monotonic', return_value=105.0):
+            self.assertEqual(cache.get("key"), ["docs"])
+        with patch('rag_cache.time.monotonic', return_value=111.0):
+            self.assertIsNone(cache.get("key"))
+
+    def test_capacity(self):
+        """The least recently used entry is evicted once full"""
+        cache = SmartRAGCache(capacity=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,11 +4,15 @@ import json
 # import openai
 import numpy as np
 
-from openai import OpenAI
 from typing import List, Tuple, Optional
 from homeassistant.core import HomeAssistant
 from langchain.docstore.document import Document
 from .logger_helper import log_to_file
+from .gpt_commands import get_openai_client
+
+# Key in hass.data holding the in-memory index: matrix, docs, dim and a
+# version that's bumped whenever a rebuild replaces it.
+INDEX_KEY = "special_agent_index"
 
 def build_vector_index(
     docs,
@@ -56,7 +60,7 @@ def build_vector_index(
     log_to_file(f"[VectorIndex] OpenAI API Key: {openai_api_key}")
 
     start_idx = 0
-    client = OpenAI(api_key=openai_api_key)
+    client = get_openai_client(openai_api_key)
     while start_idx < len(texts):
         batch = texts[start_idx : start_idx + batch_size]
         try:
@@ -375,7 +379,8 @@ def load_vector_index(
         
         return None, None, None
 
-    # Standard loading logic
+    # Standard loading logic. The matrix is read fully into memory: a rebuild
+    # rewrites embeddings.npy in place, which would crash readers of a mapping.
     try:
         embedding_matrix = np.load(embeddings_file)
         with open(mapping_file, "r", encoding="utf-8") as f:
@@ -389,12 +394,64 @@ def load_vector_index(
         return None, None, None
 
 
-def query_vector_index(index_data, query_text, k=20, openai_api_key=None, model_name="text-embedding-ada-002", hass=None):
+def get_index(hass, openai_api_key):
+    """
+    Return (embedding_matrix, doc_list, vector_dim) from hass.data, loading it
+    from disk on first use. Returns (None, None, None) if there's no index yet.
+    """
+    cached = hass.data.get(INDEX_KEY)
+    if cached is not None:
+        return cached["matrix"], cached["docs"], cached["dim"]
+
+    embedding_matrix, docs, vector_dim = load_vector_index(openai_api_key)
+    if embedding_matrix is not None:
+        set_index(hass, embedding_matrix, docs, vector_dim)
+    return embedding_matrix, docs, vector_dim
+
+def set_index(hass, embedding_matrix, docs, vector_dim):
+    """Store a (re)built index in hass.data and bump its version."""
+    previous = hass.data.get(INDEX_KEY)
+    hass.data[INDEX_KEY] = {
+        "matrix": embedding_matrix,
+        "docs": docs,
+        "dim": vector_dim,
+        "version": previous["version"] + 1 if previous else 1,
+    }
+
+def get_index_version(hass):
+    """Return the version of the in-memory index (0 if none is loaded)."""
+    cached = hass.data.get(INDEX_KEY)
+    return cached["version"] if cached else 0
+
+
+def embed_query(query_text, openai_api_key=None, model_name="text-embedding-ada-002"):
+    """
+    Embed a single query string and return it as a normalized float32 vector,
+    or None if the embedding call fails.
+    """
+    client = get_openai_client(openai_api_key)
+    try:
+        response = client.embeddings.create(
+            model=model_name,
+            input=[query_text]
+        )
+    except Exception as e:
+        log_to_file(f"[VectorIndex] Error embedding query '{query_text}': {e}")
+        return None
+
+    query_vec = np.array(response.data[0].embedding, dtype=np.float32)
+    return query_vec / (np.linalg.norm(query_vec) + 1e-9)
+
+
+def query_vector_index(index_data, query_text, k=20, openai_api_key=None, model_name="text-embedding-ada-002", hass=None, query_vector=None):
     """
     Query the vector index for documents similar to query_text.
     
     If index_data is missing (None values), and hass is provided, will attempt to rebuild
     the index automatically before continuing.
+
+    Pass query_vector (from embed_query) to reuse an embedding the caller
+    already has instead of embedding query_text again.
     """
     # Handle case where index is missing
     if not index_data or index_data[0] is None:
@@ -406,8 +463,8 @@ def query_vector_index(index_data, query_text, k=20, openai_api_key=None, model_
                 from .agent_logic import sync_do_rebuild
                 result = sync_do_rebuild(hass)
                 if result == "done":
-                    # Try loading again
-                    rebuilt_index = load_vector_index(openai_api_key)
+                    # Try loading again (the rebuild refreshed hass.data)
+                    rebuilt_index = get_index(hass, openai_api_key)
                     if rebuilt_index[0] is not None:
                         log_to_file("[VectorIndex] Successfully rebuilt and loaded index, continuing with query")
                         index_data = rebuilt_index
@@ -431,22 +488,11 @@ def query_vector_index(index_data, query_text, k=20, openai_api_key=None, model_
 
     embedding_matrix, documents, vector_dim = index_data
     
-    # 1) Embed the query text directly via openai
-    client = OpenAI(api_key=openai_api_key)
-    try:
-        response = client.embeddings.create(
-            model=model_name,
-            input=[query_text]
-        )
-        # The response is an object with 'data', each item has an 'embedding'
-        query_vector = response.data[0].embedding
-    except Exception as e:
-        log_to_file(f"[VectorIndex] Error embedding query '{query_text}': {e}")
+    # 1) + 2) Embed the query text (unless the caller already did) as a
+    #         normalized vector for cosine similarity
+    query_norm = query_vector if query_vector is not None else embed_query(query_text, openai_api_key, model_name)
+    if query_norm is None:
         return []
-
-    # 2) Convert to NumPy and normalize for cosine similarity
-    query_vec = np.array(query_vector, dtype=np.float32)
-    query_norm = query_vec / (np.linalg.norm(query_vec) + 1e-9)
     
     # 3) Normalize the document embeddings if not already
     norms = np.linalg.norm(embedding_matrix, axis=1, keepdims=True)
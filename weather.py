@@ -5,11 +5,65 @@ Functions for retrieving and processing weather data from various sources.
 
 import asyncio
 import json
-import sys
-import subprocess
+import re
+import time
 from typing import Dict, Any
 
+import aiohttp
+import orjson
+from homeassistant.helpers import aiohttp_client
+
 from .logger_helper import log_to_file
+from .config_helper import get_config_data
+
+# Entity id keyword -> (priority, sensor type). Lower priority wins when
+# several match; None marks keywords that only flag an entity as weather-related.
+_SENSOR_KEYWORDS = {
+    "temperature": (0, "temperature"),
+    "humidity": (1, "humidity"),
+    "pressure": (2, "pressure"),
+    "barometer": (2, "pressure"),
+    "wind_speed": (3, "wind_speed"),
+    "wind_direction": (4, "wind_direction"),
+    "wind_bearing": (4, "wind_direction"),
+    "rain": (5, "precipitation"),
+    "precip": (5, "precipitation"),
+    "uv": (6, "uv_index"),
+    "ultraviolet": (6, "uv_index"),
+    "weather": (7, "weather_condition"),
+    "temp": (8, None),
+    "humid": (8, None),
+    "wind": (8, None),
+}
+# Keywords that name a sensor type but don't by themselves make an entity
+# weather-related
+_NON_WEATHER_KEYWORDS = frozenset({"barometer", "ultraviolet"})
+# Longest first, so e.g. "temperature" wins over "temp" at the same position
+_SENSOR_PATTERN = re.compile("|".join(sorted(_SENSOR_KEYWORDS, key=len, reverse=True)))
+
+# Timeout for each Open-Meteo request
+_HTTP_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# Open-Meteo forecasts keyed by (lat, lon) rounded to ~1 km -> (fetched_at, data)
+_FORECAST_CACHE = {}
+_FORECAST_TTL = 300
+
+# Filters used by get_local_weather_sensors
+_WEATHER_DOMAINS = ('sensor', 'weather', 'binary_sensor')
+# Substring tests against lowercased entity ids, one regex search each
+_WEATHER_PATTERN = re.compile('temp|humid|pressure|wind|rain|precip|weather|uv')
+_WEATHER_SENSOR_PATTERN = re.compile('temperature|humidity|pressure|wind|rain|weather|uv')
+_INDOOR_PATTERN = re.compile('indoor|inside|interior|room')
+
+# unit_of_measurement (lowercased) -> sensor type, for entities whose id doesn't say
+_UNIT_SENSOR_TYPES = {
+    '°c': 'temperature', '°f': 'temperature', 'c': 'temperature', 'f': 'temperature',
+    '%': 'humidity', 'rh': 'humidity',
+    'hpa': 'pressure', 'mbar': 'pressure', 'inhg': 'pressure',
+    'm/s': 'wind_speed', 'mph': 'wind_speed', 'km/h': 'wind_speed', 'kn': 'wind_speed',
+    '°': 'wind_direction', 'deg': 'wind_direction',
+    'mm': 'precipitation', 'in': 'precipitation', 'mm/h': 'precipitation', 'in/h': 'precipitation',
+}
 
 async def fetch_weather_data(hass, api_key=None, location_query=None):
     """
@@ -27,23 +81,18 @@ async def fetch_weather_data(hass, api_key=None, location_query=None):
     log_to_file("[Weather] Starting weather data collection")
     
     # Get location information first
-    location_info = await get_location_info(hass)
+    location_info = get_location_info(hass)
     
-    # Get local weather data (sensors, forecast entities)
-    local_weather = await get_local_weather_sensors(hass)
-    
-    # Always fetch online weather data for better forecast information
-    # and to handle non-local queries
-    online_weather = {}
-    
-    # If a specific location was requested, modify location_info for the API call
     if location_query:
         log_to_file(f"[Weather] Fetching weather for location: {location_query}")
-        # We'll use the online API with the location query
-        online_weather = await get_online_weather_data(hass, location_info, location_query)
-    else:
-        # Get online data for the user's location
-        online_weather = await get_online_weather_data(hass, location_info)
+    
+    # Always fetch online weather data for better forecast information
+    # and to handle non-local queries. It is started first so the local
+    # sensor scan (sensors, forecast entities) runs while the request is in flight.
+    online_weather, local_weather = await asyncio.gather(
+        get_online_weather_data(hass, location_info, location_query),
+        get_local_weather_sensors(hass),
+    )
     
     return {
         "location": location_info,
@@ -51,7 +100,7 @@ async def fetch_weather_data(hass, api_key=None, location_query=None):
         "online_weather": online_weather
     }
 
-async def get_location_info(hass) -> dict:
+def get_location_info(hass) -> dict:
     """
     Get the location information for this Home Assistant instance.
     Returns coordinates, postal code, and other location details if available.
@@ -68,8 +117,7 @@ async def get_location_info(hass) -> dict:
             location_info["longitude"] = longitude
         
         # Get location from config
-        config_entries = hass.data.get("special_agent", {})
-        config_data = next(iter(config_entries.values())) if config_entries else {}
+        config_data = get_config_data(hass)
         
         # Use ZIP code from config if available
         if "zip_code" in config_data:
@@ -102,38 +150,27 @@ async def get_local_weather_sensors(hass) -> dict:
     
     try:
         # Look for predefined device/station IDs
-        config_entries = hass.data.get("special_agent", {})
-        config_data = next(iter(config_entries.values())) if config_entries else {}
+        config_data = get_config_data(hass)
         weather_station_id = config_data.get("weather_station_id", "washington_weather_station")
         log_to_file(f"[Weather] Looking for weather station with ID: {weather_station_id}")
         
-        # Get all states
-        all_states = list(hass.states.async_all())
-        
-        # Log all sensors for debugging
-        weather_related_entities = [state.entity_id for state in all_states 
-                             if state.entity_id.startswith(('sensor.', 'weather.', 'binary_sensor.')) 
-                             and any(keyword in state.entity_id.lower() for keyword in 
-                               ['temp', 'humid', 'pressure', 'wind', 'rain', 'precip', 'weather', 'uv'])]
-        log_to_file(f"[Weather] All weather-related entities: {', '.join(weather_related_entities)}")
+        # Only the weather-related domains; HA indexes states by domain, so
+        # this doesn't walk every entity in the house
+        all_states = hass.states.async_all(_WEATHER_DOMAINS)
         
         # First check for Home Assistant's integrated weather forecast entity
-        forecast_entity = None
-        for state in all_states:
-            if state.entity_id == "weather.forecast_home":
-                forecast_entity = state
-                log_to_file(f"[Weather] Found Home Assistant forecast entity: {state.entity_id}")
-                log_to_file(f"[Weather] Forecast attributes: {forecast_entity.attributes}")
-                
-                # Log the forecast data for debugging
-                forecast_data = forecast_entity.attributes.get("forecast", [])
-                if forecast_data:
-                    log_to_file(f"[Weather] Forecast data available: {len(forecast_data)} periods")
-                    log_to_file(f"[Weather] First forecast entry: {forecast_data[0]}")
-                else:
-                    log_to_file("[Weather] No forecast data found in entity attributes")
-                    
-                break
+        forecast_entity = hass.states.get("weather.forecast_home")
+        if forecast_entity:
+            log_to_file(f"[Weather] Found Home Assistant forecast entity: {forecast_entity.entity_id}")
+            log_to_file(f"[Weather] Forecast attributes: {forecast_entity.attributes}")
+            
+            # Log the forecast data for debugging
+            forecast_data = forecast_entity.attributes.get("forecast", [])
+            if forecast_data:
+                log_to_file(f"[Weather] Forecast data available: {len(forecast_data)} periods")
+                log_to_file(f"[Weather] First forecast entry: {forecast_data[0]}")
+            else:
+                log_to_file("[Weather] No forecast data found in entity attributes")
         
         # If we found the forecast entity, use it as our primary weather source
         if forecast_entity:
@@ -164,61 +201,63 @@ async def get_local_weather_sensors(hass) -> dict:
                 "entity_id": forecast_entity.entity_id
             }
         
-        # Find weather-related sensors, but exclude indoor sensors
-        indoor_keywords = ['indoor', 'inside', 'interior', 'room']
+        # One pass over the states collects the weather station and keyword
+        # sensors, the first weather platform and the debug list of entities
+        weather_related_entities = []
+        weather_platform = None
+        weather_parts = weather_station_id.lower().split('_') if weather_station_id else None
         
         for state in all_states:
-            if not state.entity_id.startswith(('sensor.', 'weather.', 'binary_sensor.')):
-                continue
+            entity_id = state.entity_id
+            entity_id_lower = entity_id.lower()
+            
+            if _WEATHER_PATTERN.search(entity_id_lower):
+                weather_related_entities.append(entity_id)
+            if weather_platform is None and entity_id.startswith('weather.'):
+                weather_platform = state
             
             # Skip indoor sensors
-            if any(indoor_keyword in state.entity_id.lower() for indoor_keyword in indoor_keywords):
-                log_to_file(f"[Weather] Skipping indoor sensor: {state.entity_id}")
+            if _INDOOR_PATTERN.search(entity_id_lower):
+                log_to_file(f"[Weather] Skipping indoor sensor: {entity_id}")
                 continue
                 
-            # Look for weather station by ID - use flexible matching
-            if weather_station_id:
-                # Try exact match first
-                exact_match = weather_station_id in state.entity_id.lower()
-                
-                # Try partial matches for common patterns
-                weather_parts = weather_station_id.lower().split('_')
-                partial_match = all(part in state.entity_id.lower() for part in weather_parts)
-                
-                if (exact_match or partial_match):
-                    sensor_type = _determine_sensor_type(state)
-                    if sensor_type:
-                        weather_data[sensor_type] = {
-                            "value": state.state,
-                            "unit": state.attributes.get("unit_of_measurement", ""),
-                            "entity_id": state.entity_id
-                        }
-                        log_to_file(f"[Weather] Found weather station sensor: {state.entity_id} ({sensor_type})")
-            
+            # Look for weather station by ID - use flexible matching: exact
+            # match first, then all parts of the ID for common patterns
+            station_match = weather_parts is not None and (
+                weather_station_id in entity_id_lower
+                or all(part in entity_id_lower for part in weather_parts)
+            )
             # Also look for common weather sensor keywords
-            if any(keyword in state.entity_id.lower() for keyword in 
-                  ['temperature', 'humidity', 'pressure', 'wind', 'rain', 'weather', 'uv']):
-                sensor_type = _determine_sensor_type(state)
-                if sensor_type and sensor_type not in weather_data:
-                    weather_data[sensor_type] = {
-                        "value": state.state,
-                        "unit": state.attributes.get("unit_of_measurement", ""),
-                        "entity_id": state.entity_id
-                    }
+            keyword_match = _WEATHER_SENSOR_PATTERN.search(entity_id_lower) is not None
+            if not (station_match or keyword_match):
+                continue
+            
+            sensor_type = _determine_sensor_type(state)
+            if not sensor_type:
+                continue
+            # Station sensors take precedence over keyword matches
+            if station_match or sensor_type not in weather_data:
+                weather_data[sensor_type] = {
+                    "value": state.state,
+                    "unit": state.attributes.get("unit_of_measurement", ""),
+                    "entity_id": entity_id
+                }
+                if station_match:
+                    log_to_file(f"[Weather] Found weather station sensor: {entity_id} ({sensor_type})")
+        
+        log_to_file(f"[Weather] All weather-related entities: {', '.join(weather_related_entities)}")
                     
         # Also check for integrated weather platforms
-        for state in all_states:
-            if state.entity_id.startswith('weather.'):
-                weather_data["weather_platform"] = {
-                    "condition": state.state,
-                    "temperature": state.attributes.get("temperature"),
-                    "humidity": state.attributes.get("humidity"),
-                    "pressure": state.attributes.get("pressure"),
-                    "wind_speed": state.attributes.get("wind_speed"),
-                    "wind_bearing": state.attributes.get("wind_bearing"),
-                    "entity_id": state.entity_id
-                }
-                break
+        if weather_platform is not None:
+            weather_data["weather_platform"] = {
+                "condition": weather_platform.state,
+                "temperature": weather_platform.attributes.get("temperature"),
+                "humidity": weather_platform.attributes.get("humidity"),
+                "pressure": weather_platform.attributes.get("pressure"),
+                "wind_speed": weather_platform.attributes.get("wind_speed"),
+                "wind_bearing": weather_platform.attributes.get("wind_bearing"),
+                "entity_id": weather_platform.entity_id
+            }
                 
         log_to_file(f"[Weather] Found {len(weather_data)} local weather sensors")
         return weather_data
@@ -244,52 +283,44 @@ async def get_online_weather_data(hass, location_info=None, location_query=None)
     try:
         # If location_info not provided, get it
         if not location_info:
-            location_info = await get_location_info(hass)
+            location_info = get_location_info(hass)
         
         latitude = None
         longitude = None
+        # HA's shared session keeps connections to Open-Meteo alive between requests
+        session = aiohttp_client.async_get_clientsession(hass)
         
         # If we have a location query, we need to geocode it
         if location_query:
             log_to_file(f"[Weather] Geocoding location query: {location_query}")
             try:
-                # Make sure aiohttp is installed
-                try:
-                    import aiohttp
-                except ImportError:
-                    log_to_file("[Weather] aiohttp module not found, installing...")
-                    subprocess.check_call([sys.executable, "-m", "pip", "install", "aiohttp"])
-                    import aiohttp
-                    log_to_file("[Weather] Successfully installed aiohttp module")
-                
                 # Use OpenMeteo geocoding API to get coordinates
                 geocode_url = f"https://geocoding-api.open-meteo.com/v1/search?name={location_query}&count=1&language=en&format=json"
                 
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(geocode_url) as response:
-                        if response.status == 200:
-                            geocode_data = await response.json()
+                async with session.get(geocode_url, timeout=_HTTP_TIMEOUT) as response:
+                    if response.status == 200:
+                        geocode_data = orjson.loads(await response.read())
+                        
+                        if geocode_data.get("results") and len(geocode_data["results"]) > 0:
+                            result = geocode_data["results"][0]
+                            latitude = result.get("latitude")
+                            longitude = result.get("longitude")
+                            log_to_file(f"[Weather] Geocoded {location_query} to lat: {latitude}, lon: {longitude}")
                             
-                            if geocode_data.get("results") and len(geocode_data["results"]) > 0:
-                                result = geocode_data["results"][0]
-                                latitude = result.get("latitude")
-                                longitude = result.get("longitude")
-                                log_to_file(f"[Weather] Geocoded {location_query} to lat: {latitude}, lon: {longitude}")
-                                
-                                # Add location name to location_info for LLM context
-                                location_info["queried_location"] = {
-                                    "name": result.get("name"),
-                                    "country": result.get("country"),
-                                    "admin1": result.get("admin1"),  # state/province
-                                    "latitude": latitude,
-                                    "longitude": longitude
-                                }
-                            else:
-                                log_to_file(f"[Weather] Could not geocode location: {location_query}")
-                                return {"error": f"Could not find location: {location_query}"}
+                            # Add location name to location_info for LLM context
+                            location_info["queried_location"] = {
+                                "name": result.get("name"),
+                                "country": result.get("country"),
+                                "admin1": result.get("admin1"),  # state/province
+                                "latitude": latitude,
+                                "longitude": longitude
+                            }
                         else:
-                            log_to_file(f"[Weather] Geocoding API error: {response.status}")
-                            return {"error": f"Geocoding API error: {response.status}"}
+                            log_to_file(f"[Weather] Could not geocode location: {location_query}")
+                            return {"error": f"Could not find location: {location_query}"}
+                    else:
+                        log_to_file(f"[Weather] Geocoding API error: {response.status}")
+                        return {"error": f"Geocoding API error: {response.status}"}
             except Exception as e:
                 log_to_file(f"[Weather] Error during geocoding: {e}")
                 return {"error": f"Error looking up location coordinates: {e}"}
@@ -301,18 +332,11 @@ async def get_online_weather_data(hass, location_info=None, location_query=None)
             latitude = location_info["latitude"]
             longitude = location_info["longitude"]
         
-        # Make sure aiohttp is installed
-        try:
-            import aiohttp
-        except ImportError:
-            log_to_file("[Weather] aiohttp module not found, installing...")
-            try:
-                subprocess.check_call([sys.executable, "-m", "pip", "install", "aiohttp"])
-                import aiohttp
-                log_to_file("[Weather] Successfully installed aiohttp module")
-            except Exception as e:
-                log_to_file(f"[Weather] Failed to install aiohttp: {e}")
-                return {"error": f"Failed to install required module: {e}"}
+        cache_key = (round(float(latitude), 2), round(float(longitude), 2))
+        cached = _FORECAST_CACHE.get(cache_key)
+        if cached is not None and time.monotonic() - cached[0] < _FORECAST_TTL:
+            log_to_file(f"[Weather] Using cached online weather data for {cache_key}")
+            return _forecast_result(cached[1], location_query, location_info)
         
         # Use Open-Meteo API (free, no API key required)
         url = (f"https://api.open-meteo.com/v1/forecast?"
@@ -323,30 +347,38 @@ async def get_online_weather_data(hass, location_info=None, location_query=None)
                f"&forecast_days=7"
                f"&timeformat=unixtime&timezone=auto")
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    log_to_file(f"[Weather] Retrieved online weather data with {len(data.get('daily', {}).get('time', []))} daily forecasts")
-                    
-                    # Add location context if we have it from geocoding
-                    if location_query and "queried_location" in location_info:
-                        data["location"] = location_info["queried_location"]
-                    
-                    return {
-                        "source": "open-meteo",
-                        "data": data
-                    }
-                else:
-                    error_text = await response.text()
-                    log_to_file(f"[Weather] Error fetching weather: {response.status} - {error_text}")
-                    return {"error": f"API error: {response.status}"}
+        async with session.get(url, timeout=_HTTP_TIMEOUT) as response:
+            if response.status == 200:
+                data = orjson.loads(await response.read())
+                log_to_file(f"[Weather] Retrieved online weather data with {len(data.get('daily', {}).get('time', []))} daily forecasts")
+                now = time.monotonic()
+                # Drop expired entries so one-off locations don't pile up
+                for key in [k for k, (fetched_at, _) in _FORECAST_CACHE.items() if now - fetched_at >= _FORECAST_TTL]:
+                    del _FORECAST_CACHE[key]
+                _FORECAST_CACHE[cache_key] = (now, data)
+                return _forecast_result(data, location_query, location_info)
+            else:
+                error_text = await response.text()
+                log_to_file(f"[Weather] Error fetching weather: {response.status} - {error_text}")
+                return {"error": f"API error: {response.status}"}
                     
     except Exception as e:
         log_to_file(f"[Weather] Error getting online weather: {e}")
         return {"error": str(e)}
 
 
+def _forecast_result(data, location_query, location_info) -> Dict[str, Any]:
+    """Wrap forecast data for the caller without touching the cached copy."""
+    # Add location context if we have it from geocoding
+    if location_query and "queried_location" in location_info:
+        data = {**data, "location": location_info["queried_location"]}
+    
+    return {
+        "source": "open-meteo",
+        "data": data
+    }
+
+
 def _determine_sensor_type(state) -> str:
     """
     Determine the type of weather sensor based on entity ID and attributes.
@@ -354,46 +386,32 @@ def _determine_sensor_type(state) -> str:
     """
     entity_id = state.entity_id.lower()
     
+    # One regex pass finds every keyword; the highest-priority one decides
+    # the type, same as checking them in order.
+    is_weather = False
+    best = None
+    for match in _SENSOR_PATTERN.finditer(entity_id):
+        keyword = match.group()
+        if keyword not in _NON_WEATHER_KEYWORDS:
+            is_weather = True
+        rank = _SENSOR_KEYWORDS[keyword]
+        if rank[1] is not None and (best is None or rank[0] < best[0]):
+            best = rank
+
     # Quick check if it's likely a weather sensor
-    if not any(keyword in entity_id for keyword in 
-              ['temp', 'humid', 'pressure', 'wind', 'rain', 'precip', 'weather', 'uv']):
+    if not is_weather:
         return None
-        
-    # Map entity to sensor type
-    if 'temperature' in entity_id:
-        return 'temperature'
-    elif 'humidity' in entity_id:
-        return 'humidity'
-    elif 'pressure' in entity_id or 'barometer' in entity_id:
-        return 'pressure'
-    elif 'wind_speed' in entity_id:
-        return 'wind_speed'
-    elif 'wind_direction' in entity_id or 'wind_bearing' in entity_id:
-        return 'wind_direction'
-    elif 'rain' in entity_id or 'precip' in entity_id:
-        return 'precipitation'
-    elif 'uv' in entity_id or 'ultraviolet' in entity_id:
-        return 'uv_index'
-    elif 'weather' in entity_id:
-        return 'weather_condition'
+    if best is not None:
+        return best[1]
         
     # Check units to guess type
     unit = state.attributes.get("unit_of_measurement", "").lower()
-    if unit in ['°c', '°f', 'c', 'f']:
-        return 'temperature'
-    elif unit in ['%', 'rh']:
-        return 'humidity'
-    elif unit in ['hpa', 'mbar', 'inhg']:
-        return 'pressure'
-    elif unit in ['m/s', 'mph', 'km/h', 'kn']:
-        return 'wind_speed'
-    elif unit in ['°', 'deg']:
-        return 'wind_direction'
-    elif unit in ['mm', 'in', 'mm/h', 'in/h']:
-        return 'precipitation'
-    elif unit in ['uv', 'index', '']:
+    sensor_type = _UNIT_SENSOR_TYPES.get(unit)
+    if sensor_type is not None:
+        return sensor_type
+    if unit in ('uv', 'index', ''):
         # UV index often has no unit or simply 'index'
         if 'uv' in entity_id or 'index' in entity_id:
             return 'uv_index'
         
-    return None
\ No newline at end of file
+    return None